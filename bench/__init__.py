@@ -0,0 +1,7 @@
+"""
+Reproducible benchmarks of the game hot paths
+
+Run from the game directory, where resources.yaml and res/ are:
+
+    python -m bench [--repeat N] [--seed S] [--output results.json] [names]
+"""
@@ -0,0 +1,84 @@
+import os
+# before pygame gets initialised
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import numpy
+import pygame
+
+from lib.rng import rng
+
+def measure(setup, run, repeat, seed):
+    """
+    Return the durations of repeat runs, each one with a fresh, seeded, setup
+    """
+    samples = []
+    for i in range(repeat):
+        random.seed(seed)
+        numpy.random.seed(seed)
+        rng.seed(seed)
+        state = setup()
+        start = time.time()
+        run(state)
+        samples.append(time.time() - start)
+    return samples
+
+def summarize(samples):
+    return {
+        'repeat': len(samples),
+        'min': min(samples),
+        'median': float(numpy.median(samples)),
+        'p90': float(numpy.percentile(samples, 90)),
+        'p95': float(numpy.percentile(samples, 95)),
+        'max': max(samples),
+        'mean': float(numpy.mean(samples)),
+        'samples': samples,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the game hot paths')
+    parser.add_argument('names', nargs='*',
+        help='scenarios to run, all of them by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=29)
+    parser.add_argument('--output', '-o', default='bench-results.json',
+        help='JSON results file')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    # resources are looked up relatively to the game directory
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    pygame.init()
+    pygame.display.set_mode((640, 480))
+    from bench.scenarios import SCENARIOS
+
+    results = {
+        'format': 1,
+        'unit': 's',
+        'seed': args.seed,
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'numpy': numpy.__version__,
+        'scenarios': {},
+    }
+    for (name, setup, run) in SCENARIOS:
+        if args.names and name not in args.names:
+            continue
+        stats = summarize(measure(setup, run, args.repeat, args.seed))
+        results['scenarios'][name] = stats
+        print '%-24s median %8.4fs  p95 %8.4fs' % (name, stats['median'],
+            stats['p95'])
+        sys.stdout.flush()
+
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
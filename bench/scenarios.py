@@ -0,0 +1,130 @@
+import math
+import random
+
+import numpy
+import pygame
+
+from lib import ai, ecs
+from lib.entities import Entity
+from lib.physics import BaseDisplacement
+from src import level
+
+# rows the scenarios play in, the world streams the chunks they cross
+ROWS = 65
+
+class BenchGame(object):
+    """
+    The bits of Game the level and displacements look at
+    """
+    def __init__(self, current_level):
+        self.current_level = current_level
+
+def wall_cells(lvl):
+    return zip(*numpy.nonzero(lvl.level[:, 0:ROWS] == 0))
+
+def no_setup():
+    return None
+
+def run_maze(state):
+    level.MazeLevel()
+
+def run_world(state):
+    level.WorldLevel()
+
+def build_autolayout():
+    return level.WorldLevel()
+
+def run_autolayout(lvl):
+    for y in range(min(lvl.v_size, ROWS)):
+        for x in range(lvl.h_size):
+            lvl.autolayout(x, y)
+
+def build_dig_out():
+    lvl = level.WorldLevel()
+    cells = wall_cells(lvl)
+    random.shuffle(cells)
+    return (lvl, cells[:500])
+
+def run_dig_out(state):
+    (lvl, cells) = state
+    for (x, y) in cells:
+        lvl.dig_out(lvl.tile(x, y))
+
+def build_draw():
+    lvl = level.WorldLevel()
+    entities = level.ScrolledGroup()
+    for i in range(20):
+        entity = Entity('player', entities)
+        entity.image = entity.tileset.subsurface(pygame.Rect(0, 32, 32, 32))
+        entity.rect = pygame.Rect(random.randint(0, lvl.h_size * 32 - 32),
+            random.randint(0, ROWS * 32 - 32), 32, 32)
+    return (lvl, entities, pygame.Surface((640, 480)))
+
+def run_draw(state):
+    (lvl, entities, surface) = state
+    max_x = lvl.h_size * 32 - surface.get_width()
+    max_y = ROWS * 32 - surface.get_height()
+    for frame in range(1000):
+        # sweep the whole level, back and forth
+        camera = (int(max_x * (1 + math.sin(frame / 50.)) / 2),
+            int(max_y * (1 + math.sin(frame / 200.)) / 2))
+        for group in (lvl.tiles, entities):
+            group.camera = camera
+        lvl.draw(surface)
+        entities.draw(surface)
+
+def build_collide():
+    lvl = level.WorldLevel()
+    # open some room to move around
+    for (x, y) in wall_cells(lvl):
+        if y < ROWS // 2 and random.randint(0, 2):
+            lvl.level[x, y] = 1
+    game = BenchGame(lvl)
+    movers = []
+    for i in range(100):
+        entity = Entity('player')
+        entity.rect = pygame.Rect(random.randint(32, lvl.h_size * 32 - 64),
+            random.randint(32, ROWS * 16), 16, 24)
+        entity.displacement = BaseDisplacement(entity, game)
+        velocity = (random.uniform(-10, 10), random.uniform(-10, 10))
+        movers.append((entity, velocity))
+    return (lvl, movers)
+
+def run_collide(state):
+    (lvl, movers) = state
+    for frame in range(100):
+        for (entity, velocity) in movers:
+            entity.vector = list(velocity)
+            entity.displacement.move(velocity[0], velocity[1], lvl.blockers)
+
+def build_mobs():
+    lvl = level.WorldLevel()
+    # open some room to move around
+    for (x, y) in wall_cells(lvl):
+        if y < ROWS // 2 and random.randint(0, 2):
+            lvl.level[x, y] = 1
+    game = BenchGame(lvl)
+    mobs = ecs.EntityWorld([ai.wanderer_system] + ecs.SYSTEMS)
+    kind = ecs.EntityKind.from_resources('player',
+        flags=ecs.SOLID | ecs.WANDERER | ecs.GRAVITY)
+    for i in range(500):
+        mobs.spawn(kind, (random.randint(32, lvl.h_size * 32 - 64),
+            random.randint(32, ROWS * 16)), random.randint(0, 3))
+    return (game, mobs, pygame.Surface((640, 480)))
+
+def run_mobs(state):
+    (game, mobs, surface) = state
+    for frame in range(100):
+        mobs.update(1 / 30., game)
+        mobs.draw(surface, (0, 0))
+
+# (name, setup, run), setup is not timed and its result is given to run
+SCENARIOS = [
+    ('maze_level', no_setup, run_maze),
+    ('world_level', no_setup, run_world),
+    ('autolayout', build_autolayout, run_autolayout),
+    ('dig_out_500', build_dig_out, run_dig_out),
+    ('draw_1000_frames', build_draw, run_draw),
+    ('collide_100_entities', build_collide, run_collide),
+    ('mobs_500_entities', build_mobs, run_mobs),
+]
@@ -1,56 +1,196 @@
+import argparse
+import os
 import pygame
+import random
+import struct
+import zlib
 
 
 
+from lib import resources
+from lib.ai import wanderer_system
+from lib.animations import clips
+from lib.ecs import SYSTEMS, EntityWorld
+from lib.profiler import FrameProfiler
+from lib.replay import InputRecorder, InputReplay
+from lib.rng import rng
+from lib.sounds import audio
+from lib.text import CachedText, GlyphAtlas, TextCache
 from lib.utils import *
-from src import level
+from src import level, save
 from src.entities import *
 
+# The listener method handling each event type
+HANDLERS = {
+    pygame.KEYDOWN: 'process_key_event',
+    pygame.KEYUP: 'process_key_event',
+    pygame.MOUSEBUTTONDOWN: 'process_mouse_event',
+    pygame.MOUSEBUTTONUP: 'process_mouse_event',
+    pygame.MOUSEMOTION: 'process_mouse_event',
+}
+
 class EventListener(object):
     """
     Process pygame events, such as mouse or keyboard inputs
+
+    Listeners are registered for each event type they handle, only these
+    types (and QUIT) are let in the pygame queue. Consecutive mouse motions
+    are coalesced into one.
+
+    Events are recorded by recorder when set. With a replay, events are read
+    from it instead of pygame, the game quits at the end of the recording.
     """
-    def __init__(self, game):
-        self.key_listeners = set()
-        self.mouse_listeners = set()
+    def __init__(self, game, recorder=None, replay=None):
         self.game = game
+        # event type: handlers, in registration order
+        self.handlers = {pygame.QUIT: [lambda event: game.quit()]}
+        self.recorder = recorder
+        self.replay = replay
 
     def register_listener(self, listener, event_type):
-        if event_type == pygame.KEYDOWN:
-            self.key_listeners.add(listener)
-        if event_type == pygame.MOUSEBUTTONDOWN:
-            self.mouse_listeners.add(listener)
+        handlers = self.handlers.setdefault(event_type, [])
+        handler = getattr(listener, HANDLERS[event_type])
+        if handler not in handlers:
+            handlers.append(handler)
+        self.restrict_queue()
+
+    def unregister_listener(self, listener):
+        for handlers in self.handlers.values():
+            handlers[:] = [handler for handler in handlers
+                if getattr(handler, '__self__', None) is not listener]
+
+    def restrict_queue(self):
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(list(self.handlers))
 
     def process_events(self):
-        events = [event for event in pygame.event.get()]
+        if self.replay is not None:
+            events = self.replay.next_events()
+            if events is None:
+                self.game.quit()
+                return
+        else:
+            events = coalesce_motions(pygame.event.get())
+        if self.recorder is not None:
+            self.recorder.add_events(events)
 
+        handlers = self.handlers
         for event in events:
-            if event.type == pygame.QUIT:
-                self.game.quit()
-            if event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
-                for listener in self.key_listeners:
-                    listener.process_key_event(event)
-            elif (event.type == pygame.MOUSEBUTTONDOWN or
-                        event.type == pygame.MOUSEBUTTONUP):
-                for listener in self.mouse_listeners:
-                    listener.process_mouse_event(event)
-            elif event.type == pygame.MOUSEMOTION:
-                for listener in self.mouse_listeners:
-                    listener.process_mouse_event(event)
+            for handler in handlers.get(event.type, ()):
+                handler(event)
+
+def coalesce_motions(events):
+    """
+    Return events with each run of consecutive MOUSEMOTION events merged into
+    one, at the last position and with the summed relative movement
+    """
+    coalesced = []
+    for event in events:
+        if (event.type == pygame.MOUSEMOTION and coalesced and
+                coalesced[-1].type == pygame.MOUSEMOTION):
+            rel = coalesced[-1].rel
+            coalesced[-1] = pygame.event.Event(pygame.MOUSEMOTION,
+                pos=event.pos, rel=(rel[0] + event.rel[0],
+                    rel[1] + event.rel[1]), buttons=event.buttons)
+        else:
+            coalesced.append(event)
+    return coalesced
+
+# Frame phases timed by the profiler
+PHASES = ['events', 'timers', 'entities.update', 'level.update',
+    'dirty_rects', 'level.draw', 'entities.draw', 'draw_gui', 'flip']
 
 class Game(object):
 
     # TODO: game is used everywhere, and we can't have multiple games instance
     # at the same time. Make it a singleton
-    def __init__(self):
+    def __init__(self, headless=False, frames=None, render=True, tick_rate=30,
+            fps=60, max_ticks=5, profile_csv=None, dirty_rects=False,
+            resume=False, autosave=True, seed=None, record=None, replay=None,
+            checksums=None):
+        """
+        The simulation advances by fixed ticks of 1/tick_rate seconds, while
+        frames are rendered up to fps times per second (0 for no limit) with
+        sprites interpolated between the last two ticks. A slow frame never
+        runs more than max_ticks ticks, the remaining time is dropped.
+
+        headless games are not paced by the clock, each frame advances the
+        simulation by exactly one tick, and nothing is flipped to the
+        display. When frames is set, the game stops after that many frames,
+        render=False skips drawing altogether.
+
+        Frame phases are always timed, F3 shows the profiler overlay and the
+        timings are written to profile_csv when the game exits.
+
+        dirty_rects only redraws and presents the changed parts of the screen
+        while the camera stands still.
+
+        F5 saves the game to the slots of save.file and F9 resumes the newest
+        save, as resume does when the game starts. The game is also saved
+        every save.autosave seconds unless autosave is False. Saves are
+        written by a background thread.
+
+        The simulation draws its random numbers from lib.rng, seeded with seed
+        (a random one if None). The inputs are recorded to the record file
+        when given, replay plays such a recording back, headless, and the
+        game stops at its end. Replays neither save nor resume games, the
+        saves on disk are not those of the recording. checksums receives a checksum of the game
+        state after each tick, to compare a replay with its recording.
+        """
+        self.headless = headless
+        self.frames = frames
+        self.render = render
+        self.tick_rate = tick_rate
+        self.fps = fps
+        self.max_ticks = max_ticks
+        self.frame_count = 0
+        self.profiler = FrameProfiler(PHASES, budget=1. / tick_rate)
+        self.profile_csv = profile_csv
+        self.dirty_rects = dirty_rects
+        self.last_camera = None
+        self.last_rects = []
+        self.last_gui_rects = []
+        self.last_gui_texts = None
         self.event_listener = EventListener(self)
         self.running = True
         self.finishing = False
         self.level = level.WorldLevel
         self.selected_tile = None
         self.font = pygame.font.Font('res/tobago.ttf', 35)
+        self.texts = TextCache(self.font)
+        digits = GlyphAtlas(self.font)
+        self.score_text = CachedText(self.font, glyphs=digits)
+        self.time_text = CachedText(self.font, glyphs=digits)
         self.rem_time = 0.
         self.started = False
+        self.save_file = resources.getValue('save.file')
+        self.autosave = resources.getValue('save.autosave') if autosave else 0
+        self.resume = resume
+        self.saver = None
+
+        self.replay = None
+        if replay is not None:
+            self.replay = InputReplay(replay)
+            (seed, self.tick_rate) = (self.replay.seed, self.replay.tick_rate)
+            self.headless = True
+            self.autosave = 0
+            self.resume = False
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.recorder = None
+        if record is not None:
+            self.recorder = InputRecorder(record, seed, self.tick_rate,
+                self.headless)
+        self.event_listener.recorder = self.recorder
+        self.event_listener.replay = self.replay
+        self.checksums = None
+        if checksums is not None:
+            self.checksums = open(checksums, 'w')
+        self.tick_count = 0
+        # seconds simulated since the game started, the clock of the
+        # animations and sounds
+        self.time = 0
 
         print 'Started game', id(self)
 
@@ -61,6 +201,14 @@ class Game(object):
             self.quit()
         if event.key == pygame.K_r:
             self.running = True
+        if event.key == pygame.K_F3 and event.type == pygame.KEYDOWN:
+            self.profiler.visible = not self.profiler.visible
+        if self.replay is not None:
+            return
+        if event.key == pygame.K_F5 and event.type == pygame.KEYDOWN:
+            self.save_game()
+        if event.key == pygame.K_F9 and event.type == pygame.KEYDOWN:
+            self.resume = True
 
     def process_mouse_event(self, event):
         if (event.type == pygame.MOUSEBUTTONDOWN or
@@ -89,35 +237,132 @@ class Game(object):
         self.selected_tile = (x,y)
 
     def do_splash(self, screen):
-        color = (255,255,255)
-        txt = self.font.render('YADIG', False, color)
+        if not self.render:
+            return
+        txt = self.texts.render('YADIG')
         screen.blit(txt, (320 - txt.get_width()/2,40))
-        txt = self.font.render('Loading...', False, color)
+        txt = self.texts.render('Loading...')
         screen.blit(txt, (320 - txt.get_width()/2, 400))
-        screen.blit(pygame.image.load('res/splash.png'), (60,100))
-        pygame.display.flip()
+        screen.blit(resources.loadImage(resources.getImage('splash')), (60,100))
+        self.flip()
+
+    def flip(self, rects=None):
+        """
+        Present the screen, only the rects given if any
+        """
+        if self.headless:
+            return
+        if rects is None:
+            pygame.display.flip()
+        elif rects:
+            pygame.display.update(rects)
 
-    def draw_gui(self, screen):
-        score = self.font.render('%09d' % self.player.score,
-                False, (255,255,255))
-        screen.blit(score, (4,4))
+    def gui_texts(self):
+        """
+        Return the score and remaining time strings
+        """
         r_min = self.rem_time / 60
         r_sec = self.rem_time % 60
-        r_time = self.font.render('%d:%02d'%(r_min, r_sec),
-            False, (255,255,255))
-        screen.blit(r_time, (640-r_time.get_width()-4, 4))
+        return ('%09d' % self.player.score, '%d:%02d'%(r_min, r_sec))
+
+    def gui_blits(self, texts=None):
+        """
+        Return the (surface, position) of the HUD elements
+        """
+        if texts is None:
+            texts = self.gui_texts()
+        score = self.score_text.render(texts[0])
+        r_time = self.time_text.render(texts[1])
+        return [(score, (4,4)), (r_time, (640-r_time.get_width()-4, 4))]
+
+    def draw_gui(self, screen, blits=None):
+        if blits is None:
+            blits = self.gui_blits()
+        screen.blits(blits, False)
+
+    def draw_frame(self, screen, alpha):
+        """
+        Draw the level, entities and HUD
+
+        In dirty rects mode, when the camera did not move, only the screen
+        areas covered by moving sprites, retouched tiles or a changed HUD are
+        redrawn, clipped to each of them in turn. Return the list of those
+        rects, None when the whole screen was drawn.
+        """
+        profiler = self.profiler
+        camera = self.entities.interpolated_camera(alpha)
+        rects = None
+        gui = None
+        touched = self.current_level.pop_touched_rects()
+        if self.dirty_rects:
+            # the HUD is rendered here, its rects are needed
+            gui_texts = self.gui_texts()
+            gui = self.gui_blits(gui_texts)
+            size = screen.get_size()
+            gui_rects = [image.get_rect(topleft=position)
+                for (image, position) in gui]
+            sprite_rects = (self.entities.screen_rects(size, alpha=alpha) +
+                self.mobs.screen_rects(camera, size, alpha) +
+                self.current_level.screen_rects(size, alpha))
+            if (camera == self.last_camera and not profiler.visible and
+                    self.rem_time > 0):
+                rects = self.last_rects + sprite_rects + [
+                    rect.move(-camera[0], -camera[1]) for rect in touched]
+                if gui_texts != self.last_gui_texts:
+                    rects += self.last_gui_rects + gui_rects
+                rects = merge_rects(rects)
+            self.last_camera = camera
+            self.last_rects = sprite_rects
+            self.last_gui_rects = gui_rects
+            self.last_gui_texts = gui_texts
+        profiler.mark('dirty_rects')
+
+        if rects is None:
+            self.draw_layers(screen, camera, alpha, gui)
+        else:
+            # merged rects do not overlap, each area is drawn once
+            for rect in rects:
+                screen.set_clip(rect)
+                self.draw_layers(screen, camera, alpha, gui)
+            screen.set_clip(None)
+
+        if profiler.visible:
+            profiler.draw(screen)
+        return rects
+
+    def draw_layers(self, screen, camera, alpha, gui=None):
+        """
+        Draw the level, entities and HUD in the clip of screen
+        """
+        profiler = self.profiler
+        self.current_level.draw(screen, alpha)
+        profiler.mark('level.draw')
+        self.mobs.draw(screen, camera, alpha)
+        self.entities.draw(screen, alpha=alpha)
+        profiler.mark('entities.draw')
+        self.draw_gui(screen, gui)
+        profiler.mark('draw_gui')
 
     def do_finish(self, screen):
-        txt = self.font.render('Game Over !', False, (255,255,255))
-        screen.blit(txt, (320-txt.get_width()/2, 40))
-        txt = self.font.render('Press R to restart', False, (255,255,255))
-        screen.blit(txt, (320-txt.get_width()/2, 70))
-        pygame.display.flip()
+        if self.headless and self.replay is None:
+            # nobody is there to press R
+            self.finishing = False
+            return
+        if self.render:
+            txt = self.texts.render('Game Over !')
+            screen.blit(txt, (320-txt.get_width()/2, 40))
+            txt = self.texts.render('Press R to restart')
+            screen.blit(txt, (320-txt.get_width()/2, 70))
+        self.flip()
         self.finishing = True
 
         while self.finishing:
             self.event_listener.process_events()
             if self.running:
+                if self.recorder is not None:
+                    # the events up to the restart are replayed at once,
+                    # before the first tick of the new game
+                    self.recorder.end_tick()
                 self.started = False
                 self.finishing = False
                 self.main(screen)
@@ -125,69 +370,277 @@ class Game(object):
     def add_time(self):
         self.rem_time += 20
 
+    def save_game(self):
+        """
+        Save the game in the background, unless the previous save is still
+        being written
+        """
+        if self.saver is not None and self.saver.is_alive():
+            return False
+        (header, chunks) = save.snapshot(self)
+        # the save the level was resumed from is mapped, keep it
+        saved = self.current_level.saved
+        busy = [saved.filename] if saved is not None else []
+        (header['serial'], path) = save.next_slot(self.save_file, busy)
+        self.saver = save.write_async(path, header, chunks)
+        return True
+
+    def close_level(self):
+        """
+        Wait for the save being written, which may read the level, and close
+        the level
+        """
+        if self.saver is not None:
+            self.saver.join()
+        self.current_level.close()
+
+    def load_game(self):
+        """
+        Return the SavedGame to resume, None if there is none
+        """
+        try:
+            return save.load(self.save_file)
+        except (IOError, ValueError), e:
+            print "Can't resume game: %s" % e
+            return None
+
+    def checksum(self):
+        """
+        Return a CRC of the simulation state: player, entities, timers and the
+        level cells in memory
+        """
+        player = self.player
+        crc = zlib.crc32(struct.pack('<iIdd', player.score, self.seed,
+            self.rem_time, self.e_time))
+        for entity in self.entities:
+            crc = zlib.crc32(struct.pack('<4i', *entity.rect), crc)
+        mobs = self.mobs
+        crc = zlib.crc32(mobs.position[mobs.alive()].tostring(), crc)
+        crc = zlib.crc32(struct.pack('<2i', *self.entities.camera), crc)
+        for cells in self.current_level.state_arrays():
+            crc = zlib.crc32(cells, crc)
+        return crc & 0xffffffff
+
+    def tick(self, dt):
+        """
+        Advance the simulation by dt seconds
+        """
+        if self.recorder is not None:
+            self.recorder.end_tick()
+        self.time += dt
+        if self.started:
+            self.e_time += dt
+            self.w_time += dt
+            self.s_time += dt
+        if self.e_time >= 1:
+            self.rem_time -= int(self.e_time)
+            self.e_time = 0
+        if self.w_time >= 3:
+            self.current_level.add_worm()
+            self.w_time = 0
+        if self.autosave and self.s_time >= self.autosave:
+            self.save_game()
+            self.s_time = 0
+        # worms and autosaves
+        self.profiler.mark('timers')
+
+        # update state of game
+        self.entities.update(dt, self)
+        self.mobs.update(dt, self)
+        self.profiler.mark('entities.update')
+        self.current_level.update(dt, self)
+        self.profiler.mark('level.update')
+
+        self.tick_count += 1
+        if self.checksums is not None:
+            self.checksums.write('%d %08x\n' % (self.tick_count,
+                self.checksum()))
+
     def init(self, screen):
-        self.event_listener.register_listener(self, pygame.KEYDOWN)
-        self.event_listener.register_listener(self, pygame.MOUSEBUTTONDOWN)
+        rng.seed(self.seed)
+        resources.preload('player', 'level', 'dig', 'gems', 'selected',
+            'splash')
+        clips.preload('player', 'dig')
+        audio.init()
+        for event_type in HANDLERS:
+            self.event_listener.register_listener(self, event_type)
         self.main(screen)
-
-    def main(self, screen):
-        clock = pygame.time.Clock()
+        self.close_level()
+        for output in (self.recorder, self.checksums):
+            if output is not None:
+                output.close()
+        if self.profile_csv:
+            self.profiler.dump_csv(self.profile_csv)
+
+    def start_level(self, saved=None):
+        """
+        Create the level and the player, resumed from saved if given
+        """
         self.rem_time = 180.
-
-        # draw screen
-        screen.fill((0,0,0))
-        pygame.display.flip()
-        self.do_splash(screen)
-        self.current_level = self.level()
+        if hasattr(self, 'current_level'):
+            self.close_level()
+        if saved is None:
+            self.current_level = self.level()
+        else:
+            self.current_level = self.level(saved)
 
         entities = level.ScrolledGroup()
         self.entities = entities
         self.entities.debug = False
+        if hasattr(self, 'player'):
+            self.event_listener.unregister_listener(self.player.brain)
         self.player = Player(self, entities)
         self.player.move_to(self.current_level.start_pos)
+        # enemies and projectiles, see lib.ecs
+        self.mobs = EntityWorld([wanderer_system] + SYSTEMS)
+        if saved is not None:
+            self.player.move_to(saved.player)
+            self.player.score = saved.score
+            self.rem_time = saved.rem_time
+        self.last_camera = None
+        self.selected_tile = None
+
+        self.e_time = 0
+        self.w_time = 0
+        self.s_time = 0
+
+    def main(self, screen):
+        clock = pygame.time.Clock()
 
-        e_time = 0
-        w_time = 0
+        # draw screen
+        screen.fill((0,0,0))
+        self.flip()
+        self.do_splash(screen)
+        saved = None
+        if self.resume:
+            saved = self.load_game()
+            self.resume = False
+        self.start_level(saved)
+
+        step = 1. / self.tick_rate
+        accumulator = 0.
+        if self.replay is not None:
+            self.started = self.replay.started
+        elif self.headless:
+            self.started = True
         while self.running:
 
-            dt = clock.tick(30)
-
-            if self.started:
-                e_time += dt / 1000.
-                w_time += dt / 1000.
-            if e_time >= 1:
-                self.rem_time -= int(e_time)
-                e_time = 0
-            if w_time >= 3:
-                self.current_level.add_worm()
-                w_time = 0
-            # process events
-            self.event_listener.process_events()
+            if self.headless:
+                accumulator += step
+            else:
+                # do not try to catch up on more than max_ticks
+                accumulator += min(clock.tick(self.fps) / 1000.,
+                    step * self.max_ticks)
 
-            # update state of game
-            entities.update(dt / 1000., self)
-            self.current_level.update(dt / 1000., self)
+            profiler = self.profiler
+            profiler.begin_frame()
 
-            self.current_level.draw(screen)
-            entities.draw(screen)
-            self.draw_gui(screen)
+            # process events
+            self.event_listener.process_events()
+            if self.resume:
+                saved = self.load_game()
+                self.resume = False
+                if saved is not None:
+                    self.start_level(saved)
+            profiler.mark('events')
+
+            while accumulator >= step and self.running:
+                self.tick(step)
+                accumulator -= step
+            alpha = accumulator / step
+
+            rects = None
+            if self.render:
+                rects = self.draw_frame(screen, alpha)
 
             if self.rem_time <= 0:
                 self.started = False
                 self.running = False
                 self.finishing = True
-                fog = pygame.Surface((640,480))
-                fog.fill((128,128,128,120))
-                screen.blit(fog, (0,0), special_flags = pygame.BLEND_RGBA_MULT)
-            pygame.display.flip()
+                if self.render:
+                    fog = pygame.Surface((640,480))
+                    fog.fill((128,128,128,120))
+                    screen.blit(fog, (0,0),
+                        special_flags = pygame.BLEND_RGBA_MULT)
+            self.flip(rects)
+            profiler.mark('flip')
+            profiler.end_frame()
+
+            self.frame_count += 1
+            if self.frames is not None and self.frame_count >= self.frames:
+                self.running = False
+                self.finishing = False
 
         if self.finishing:
             self.do_finish(screen)
 
-if __name__ == '__main__':
+def merge_rects(rects):
+    """
+    Return rects with the overlapping ones merged together
+    """
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        # growing a rect may make it overlap rects merged before
+        overlapping = rect.collidelistall(merged)
+        while overlapping:
+            for i in reversed(overlapping):
+                rect.union_ip(merged.pop(i))
+            overlapping = rect.collidelistall(merged)
+        merged.append(rect)
+    return merged
+
+def init_screen(headless=False):
+    """
+    Initialise pygame and return the screen surface
+
+    Headless screens use SDL dummy video and audio drivers, which must be
+    selected before pygame is initialised.
+    """
+    flags = pygame.HWSURFACE|pygame.DOUBLEBUF
+    if headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+        flags = 0
     pygame.mixer.pre_init(buffer=2048)
     pygame.init()
     # TODO : screen size from conf ? Or at least constant
-    screen = pygame.display.set_mode((640,480), pygame.HWSURFACE|pygame.DOUBLEBUF)
+    return pygame.display.set_mode((640,480), flags)
 
-    Game().init(screen)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Yet Another Digging Game')
+    parser.add_argument('--headless', action='store_true',
+        help='run on SDL dummy drivers, as fast as possible')
+    parser.add_argument('--frames', type=int, default=None,
+        help='stop after this many frames')
+    parser.add_argument('--no-render', dest='render', action='store_false',
+        help='do not draw anything')
+    parser.add_argument('--tick-rate', type=int, default=30,
+        help='simulation ticks per second')
+    parser.add_argument('--fps', type=int, default=60,
+        help='maximum frames drawn per second, 0 for no limit')
+    parser.add_argument('--profile-csv', default=None,
+        help='write the last frames phase timings to this file on exit')
+    parser.add_argument('--dirty-rects', action='store_true',
+        help='only redraw the changed parts of the screen')
+    parser.add_argument('--resume', action='store_true',
+        help='resume the saved game')
+    parser.add_argument('--no-autosave', dest='autosave', action='store_false',
+        help='only save the game on F5')
+    parser.add_argument('--seed', type=int, default=None,
+        help='seed of the simulation random numbers')
+    parser.add_argument('--record', default=None,
+        help='record the inputs to this file')
+    parser.add_argument('--replay', default=None,
+        help='replay recorded inputs, headless')
+    parser.add_argument('--checksums', default=None,
+        help='write a checksum of the game state after each tick to this file')
+    args = parser.parse_args()
+
+    screen = init_screen(args.headless or args.replay is not None)
+
+    Game(args.headless, args.frames, args.render, args.tick_rate,
+        args.fps, profile_csv=args.profile_csv,
+        dirty_rects=args.dirty_rects, resume=args.resume,
+        autosave=args.autosave, seed=args.seed, record=args.record,
+        replay=args.replay, checksums=args.checksums).init(screen)
@@ -1,6 +1,14 @@
-import random
+import numpy
 
-from lib.utils import DIRECTIONS, UP, DOWN, LEFT, RIGHT
+from lib.ecs import BLOCKED_X, BLOCKED_Y, DIRECTION_VECTORS, GRAVITY, WANDERER
+from lib.rng import rng
+from lib.utils import DIRECTIONS, LEFT
+
+# how long wanderers keep their heading, in seconds
+WANDER_DELAYS = (0.1, 1.5)
+
+# DIRECTION_VECTORS as tuples, for single entities
+VECTORS = [tuple(vector) for vector in DIRECTION_VECTORS.tolist()]
 
 class DumbBrain(object):
     def __init__(self, entity):
@@ -13,38 +21,70 @@ class DumbBrain(object):
         pass
 
 class WandererBrain(DumbBrain):
+    """
+    Brain of a single wanderer Entity, wanderer_system() does the same for all
+    the wanderers of an EntityWorld
+    """
     def __init__(self, entity):
         super(WandererBrain, self).__init__(entity)
-        self.elapsed_time = 0
+        self.think_time = None
 
     def touched_by(self, sprite):
         self.change_direction()
 
     def change_direction(self):
-        available_dirs = DIRECTIONS[:]
-        available_dirs.pop(self.entity.direction)
-        self.entity.direction = random.choice(available_dirs)
+        # one of the three other directions
+        self.entity.direction = (self.entity.direction +
+            rng.randint(1, 3)) % 4
 
     def think(self, delta_time, game):
         # Work only on entities that can move
         if not self.entity.displacement :
             return
 
-        self.elapsed_time += delta_time
-        if self.elapsed_time > random.randrange(1,15)/10.:
-            #self.entity.direction = random.choice(DIRECTIONS)
-            self.elapsed_time = 0
+        if self.think_time is None:
+            self.think_time = rng.uniform(*WANDER_DELAYS)
+        self.think_time -= delta_time
+        if self.think_time <= 0:
+            self.entity.direction = rng.choice(DIRECTIONS)
+            self.think_time = rng.uniform(*WANDER_DELAYS)
+
+        (dx, dy) = VECTORS[self.entity.direction]
+        vector = self.entity.vector
+        vector[0] = dx * self.entity.h_speed * delta_time
+        vector[1] = dy * self.entity.v_speed * delta_time
 
-        # Reset vector
-        self.entity.vector = [0,0]
-        if self.entity.direction == LEFT:
-            self.entity.vector[0] = -self.entity.h_speed * delta_time
+def wanderer_system(world, dt, game):
+    """
+    Think for all the wanderers of world at once
 
-        if self.entity.direction == RIGHT:
-            self.entity.vector[0] = +self.entity.h_speed * delta_time
+    Wanderers walk ahead at their speed, the ones with gravity keep their
+    falling speed when walking sideways. They pick a random direction when
+    their think_time runs out (entities just spawned have a think_time of 0
+    and keep their direction for a first delay), and turn to one of the three
+    other directions when they hit a wall ahead or could not move at all.
+    """
+    rows = world.alive() & (world.flags & WANDERER > 0)
+    spawned = numpy.flatnonzero(rows & (world.think_time == 0))
+    world.think_time[spawned] = world.random.uniform(WANDER_DELAYS[0],
+        WANDER_DELAYS[1], len(spawned))
+    world.think_time[rows] -= dt
+    bored = numpy.flatnonzero(rows & (world.think_time <= 0))
+    world.direction[bored] = world.random.randint(0, 4, len(bored))
+    world.think_time[bored] = world.random.uniform(WANDER_DELAYS[0],
+        WANDER_DELAYS[1], len(bored))
 
-        if self.entity.direction == UP:
-            self.entity.vector[1] = -self.entity.v_speed * delta_time
+    blocked = numpy.where(world.direction < LEFT, world.flags & BLOCKED_Y,
+        world.flags & BLOCKED_X) > 0
+    still = (world.velocity == 0).all(1)
+    still[spawned] = False
+    turning = numpy.flatnonzero(rows & (blocked | still))
+    world.direction[turning] = (world.direction[turning] +
+        world.random.randint(1, 4, len(turning))) % 4
 
-        if self.entity.direction == DOWN:
-            self.entity.vector[1] = +self.entity.v_speed * delta_time
+    velocity = (DIRECTION_VECTORS[world.direction[rows]] *
+        world.speed[rows, numpy.newaxis])
+    sideways = ((world.direction[rows] >= LEFT) &
+        (world.flags[rows] & GRAVITY > 0))
+    velocity[sideways, 1] = world.velocity[rows][sideways, 1]
+    world.velocity[rows] = velocity
@@ -1,7 +1,57 @@
 import pygame
 
+import resources
+from sounds import audio
 from utils import UP, DOWN, LEFT, RIGHT
 
+class Clip(object):
+    """
+    The frames of an animation and the seconds each one is shown
+    """
+    def __init__(self, frames, frame_time):
+        self.frames = frames
+        self.frame_time = frame_time
+        self.duration = len(frames) * frame_time
+
+    def frame(self, time):
+        """
+        Return the frame shown time seconds after the start, looping
+        """
+        return self.frames[int(time / self.frame_time) % len(self.frames)]
+
+class ClipRegistry(object):
+    """
+    Clips of the sprite sheets, sliced once and shared
+
+    The clips of a resource are listed in resources.yaml under its clips key,
+    as name: [x, y, frame count, seconds per frame], the frames being 32x32
+    and laid out left to right from (x, y).
+    """
+    def __init__(self):
+        self.clips = {}
+
+    def get(self, resname, name):
+        clip = self.clips.get((resname, name), None)
+        if clip is None:
+            self.preload(resname)
+            clip = self.clips[(resname, name)]
+        return clip
+
+    def preload(self, *resnames):
+        for resname in resnames:
+            tileset = resources.loadImage(resources.getImage(resname))
+            clips = resources.getValue('%s.clips' % resname)
+            for (name, (x, y, count, frame_time)) in clips.items():
+                if (resname, name) in self.clips:
+                    continue
+                frames = [tileset.subsurface(pygame.Rect(left, y, 32, 32))
+                    for left in range(x, x + count * 32, 32)]
+                self.clips[(resname, name)] = Clip(frames, frame_time)
+
+    def clear(self):
+        self.clips.clear()
+
+clips = ClipRegistry()
 
 class Animation(object):
 
@@ -23,104 +73,56 @@ class StaticAnimation(Animation):
 
 class EntityAnimation(Animation):
     """
-    Animates entity or anything that have 4 animations (one per direction) of 3
-    frames each
+    Animates entity or anything that have 4 clips (one per direction), named
+    after the directions, with its game time
     """
+    names = {UP: 'up', DOWN: 'down', LEFT: 'left', RIGHT: 'right'}
+
     def __init__(self, entity):
         super(EntityAnimation, self).__init__(entity)
-        # TODO: handles more (or less) than three frames per animation
-        self.sprites = {
-                'up':[
-                    entity.tileset.subsurface(pygame.Rect(0,96,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(32,96,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(64,96,32,32)),
-                    ],
-                'down':[
-                    entity.tileset.subsurface(pygame.Rect(0,96,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(32,96,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(64,96,32,32)),
-                    ],
-                'left':[
-                    entity.tileset.subsurface(pygame.Rect(0,32,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(32,32,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(64,32,32,32)),
-                    ],
-                'right':[
-                    entity.tileset.subsurface(pygame.Rect(0,64,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(32,64,32,32)),
-                    entity.tileset.subsurface(pygame.Rect(64,64,32,32)),
-                    ],
-                }
-        self.elapsed_time = 0
-        self.frame = 0
-
-        self.entity.image = self.sprites['right'][0]
-        self.last_dir = self.entity.direction
-
-    def animate(self, delta_time, game):
-        speed = self.entity.h_speed
-        self.elapsed_time += delta_time
-
+        self.clips = dict((direction, clips.get(entity.name, name))
+            for (direction, name) in self.names.items())
+        self.start = None
 
+        self.entity.image = self.clips[RIGHT].frames[0]
 
-        if self.elapsed_time > 10./speed*2:
-            self.frame = (self.frame+1)%3
-            self.elapsed_time = 0
-
-        if self.entity.direction == LEFT:
-            self.entity.image = self.sprites['left'][self.frame]
-        if self.entity.direction == RIGHT:
-            self.entity.image = self.sprites['right'][self.frame]
-        # if self.entity.direction == UP:
-        #     self.entity.image = self.sprites['up'][self.frame]
-        if self.entity.direction == DOWN:
-            self.entity.image = self.sprites['down'][self.frame]
+    def animate(self, delta_time, game):
+        if self.start is None:
+            self.start = game.time
+        # the up clip is not shown, entities keep their last image
+        if self.entity.direction != UP:
+            self.entity.image = self.clips[self.entity.direction].frame(
+                game.time - self.start)
 
 class EffectAnimation(pygame.sprite.Sprite):
-
-    tileset = pygame.image.load('res/dig.png')
+    """
+    Plays a clip of the dig effects once, then disappears
+    """
+    names = ['hit', 'dig']
 
     def __init__(self, tileno, *groups):
         super(EffectAnimation, self).__init__(*groups)
-
-        yoffset = tileno*32
-        self.sprites = [
-                        self.tileset.subsurface(pygame.Rect(0,yoffset,32,32)),
-                        self.tileset.subsurface(pygame.Rect(32,yoffset,32,32)),
-                        self.tileset.subsurface(pygame.Rect(64,yoffset,32,32)),
-                        self.tileset.subsurface(pygame.Rect(96,yoffset,32,32)),
-                    ]
-        self.elapsed_time = 0
-        self.frame = 0
-        self.image = self.sprites[0]
+        self.clip = clips.get('dig', self.names[tileno])
+        self.start = None
+        self.image = self.clip.frames[0]
         self.layer=10
 
+        self.tileno = tileno
         self.sounds = [
-            pygame.mixer.Sound('res/dig.ogg'),
-            pygame.mixer.Sound('res/digout.ogg'),
+            resources.getValue('dig.hitsound'),
+            resources.getValue('dig.digsound'),
         ]
-        self.channel = pygame.mixer.Channel(1)
-        self.play_sound(tileno)
-
 
     def update(self, delta_time, game):
-
-        self.elapsed_time += delta_time
-        if self.frame >= len(self.sprites)-1:
+        if self.start is None:
+            # the effect starts, and sounds, with its first update
+            self.start = game.time
+            self.play_sound(self.tileno, game.time)
+        elapsed = game.time - self.start
+        if elapsed >= self.clip.duration:
             self.kill()
             return
+        self.image = self.clip.frame(elapsed)
 
-        if self.elapsed_time > 0.1:
-            self.frame = (self.frame+1)%len(self.sprites)
-            self.elapsed_time = 0
-
-        self.image = self.sprites[self.frame]
-
-    def play_sound(self, tileno):
-        self.channel.play(self.sounds[tileno])
-
-    def kill(self):
-        self.channel.stop()
-        super(EffectAnimation, self).kill()
-
-
+    def play_sound(self, tileno, time):
+        audio.play(self.sounds[tileno], time)
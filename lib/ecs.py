@@ -0,0 +1,257 @@
+"""
+Array backed entities
+
+An EntityWorld keeps its entities as rows of NumPy arrays (positions,
+velocities, speeds, directions, flags, animation frames) and updates them with
+systems, functions running over all the rows at once. There is no Python
+object nor method call per entity and per frame, only the drawing of visible
+entities loops over them.
+
+The brains of the entities are systems too, see lib.ai, they run before the
+SYSTEMS moving the entities.
+"""
+import numpy
+
+from lib import resources
+from lib.animations import EntityAnimation, clips
+from lib.physics import Displacement
+from lib.rng import rng
+from lib.sounds import audio
+from lib.utils import UP, DOWN, LEFT, RIGHT
+
+# flags
+SOLID = 1       # blocked by the level walls
+GRAVITY = 2     # falls
+RESTING = 4     # stands on a wall
+BLOCKED_X = 8   # hit a wall moving horizontally during the last update
+WANDERER = 16   # walks straight ahead, turns when blocked
+REBOUND = 32    # bounces off walls instead of stopping
+BLOCKED_Y = 64  # hit a wall moving vertically during the last update
+
+# unit vectors, indexed by direction
+DIRECTION_VECTORS = numpy.zeros((4, 2))
+DIRECTION_VECTORS[UP] = (0, -1)
+DIRECTION_VECTORS[DOWN] = (0, 1)
+DIRECTION_VECTORS[LEFT] = (-1, 0)
+DIRECTION_VECTORS[RIGHT] = (1, 0)
+
+class EntityKind(object):
+    """
+    What entities of a kind share: size, speed, flags and animation frames
+
+    frames[direction] is the list of the 3 frames of the walk animation in
+    that direction, each shown frame_time seconds. hit_sound is played when
+    they hit a wall.
+    """
+    def __init__(self, name, frames, size=(32, 32), speed=0, flags=0,
+            frame_time=0.1, hit_sound=None):
+        self.name = name
+        self.frames = frames
+        self.size = size
+        self.speed = speed
+        self.flags = flags
+        self.frame_time = frame_time
+        self.hit_sound = hit_sound
+
+    @classmethod
+    def from_resources(cls, name, size=(32, 32), flags=0):
+        """
+        Build a kind from the resources entry name, with the direction clips
+        EntityAnimation expects
+        """
+        walk = dict((direction, clips.get(name, clip))
+            for (direction, clip) in EntityAnimation.names.items())
+        frames = dict((direction, clip.frames)
+            for (direction, clip) in walk.items())
+        return cls(name, frames, size, resources.getValue('%s.speed' % name),
+            flags, walk[RIGHT].frame_time)
+
+class EntityWorld(object):
+    """
+    Entities stored as rows of arrays, updated by systems
+
+    Rows of dead entities have a kind of -1 and are reused by spawn(). The
+    arrays grow as needed, row indexes stay valid until the entity is
+    killed.
+    """
+    def __init__(self, systems=None, capacity=64):
+        self.kinds = []
+        self.capacity = 0
+        self.kind = numpy.zeros(0, dtype=numpy.int16)
+        self.position = numpy.zeros((0, 2))
+        self.previous = numpy.zeros((0, 2))
+        self.velocity = numpy.zeros((0, 2))
+        self.size = numpy.zeros((0, 2), dtype=numpy.int32)
+        self.speed = numpy.zeros(0)
+        self.direction = numpy.zeros(0, dtype=numpy.int8)
+        self.flags = numpy.zeros(0, dtype=numpy.uint8)
+        self.frame = numpy.zeros(0, dtype=numpy.int8)
+        self.frame_time = numpy.zeros(0)
+        self.animation_start = numpy.zeros(0)
+        self.think_time = numpy.zeros(0)
+        self.grow(capacity)
+        # seconds simulated, the clock of the animations
+        self.time = 0
+        self.random = numpy.random.RandomState(rng.getrandbits(32))
+        if systems is None:
+            systems = SYSTEMS
+        self.systems = list(systems)
+
+    def __len__(self):
+        return int(numpy.count_nonzero(self.kind >= 0))
+
+    def grow(self, capacity):
+        added = capacity - self.capacity
+        for name in ('kind', 'position', 'previous', 'velocity', 'size',
+                'speed', 'direction', 'flags', 'frame', 'frame_time',
+                'animation_start', 'think_time'):
+            array = getattr(self, name)
+            extra = numpy.zeros((added,) + array.shape[1:], dtype=array.dtype)
+            setattr(self, name, numpy.concatenate([array, extra]))
+        self.kind[self.capacity:] = -1
+        self.capacity = capacity
+
+    def spawn(self, kind, position, direction=RIGHT, velocity=(0, 0)):
+        """
+        Add an entity of kind at position (its top left corner), return its
+        row
+        """
+        if kind not in self.kinds:
+            self.kinds.append(kind)
+        free = numpy.flatnonzero(self.kind < 0)
+        if not len(free):
+            self.grow(self.capacity * 2 or 64)
+            free = numpy.flatnonzero(self.kind < 0)
+        row = free[0]
+        self.kind[row] = self.kinds.index(kind)
+        self.position[row] = position
+        self.previous[row] = position
+        self.velocity[row] = velocity
+        self.size[row] = kind.size
+        self.speed[row] = kind.speed
+        self.direction[row] = direction
+        self.flags[row] = kind.flags
+        self.frame[row] = 0
+        self.frame_time[row] = kind.frame_time
+        self.animation_start[row] = self.time
+        self.think_time[row] = 0
+        return row
+
+    def kill(self, row):
+        self.kind[row] = -1
+
+    def alive(self):
+        return self.kind >= 0
+
+    def update(self, dt, game):
+        self.time += dt
+        self.previous[:] = self.position
+        for system in self.systems:
+            system(self, dt, game)
+
+    def placed_sprites(self, camera, size, alpha=1.):
+        """
+        Return the (image, screen position) of the entities visible on a
+        surface of size, alpha interpolates between their positions before and
+        after the last update
+        """
+        position = self.previous + (self.position - self.previous) * alpha
+        screen = numpy.rint(position).astype(numpy.int32) - camera
+        visible = numpy.flatnonzero(self.alive() &
+            (screen[:, 0] + self.size[:, 0] > 0) & (screen[:, 0] < size[0]) &
+            (screen[:, 1] + self.size[:, 1] > 0) & (screen[:, 1] < size[1]))
+        kinds = self.kinds
+        return [(kinds[self.kind[row]].frames[self.direction[row]][
+                self.frame[row]], tuple(screen[row])) for row in visible]
+
+    def screen_rects(self, camera, size, alpha=1.):
+        return [image.get_rect(topleft=position)
+            for (image, position) in self.placed_sprites(camera, size, alpha)]
+
+    def draw(self, surface, camera, alpha=1.):
+        surface.blits(self.placed_sprites(camera, surface.get_size(), alpha),
+            False)
+
+def gravity_system(world, dt, game):
+    """
+    Entities with gravity gain Displacement.gravity pixels per second of
+    falling speed each second, like Displacement.apply_gravity() gives them
+    """
+    rows = world.alive() & (world.flags & GRAVITY > 0)
+    world.velocity[rows, 1] += Displacement.gravity * dt
+
+def movement_system(world, dt, game):
+    """
+    Move the entities by their velocity, one axis after the other, keeping
+    them in the level and out of its walls (for solid ones)
+
+    The level edges stop entities like walls do. Entities are moved by less
+    than a tile per update, so checking the cells under their corners is
+    enough.
+    """
+    level = game.current_level
+    bounds = (level.h_size * 32, level.v_size * 32)
+    alive = world.alive()
+    world.flags[alive] &= 0xff ^ (BLOCKED_X | BLOCKED_Y | RESTING)
+    for axis in (0, 1):
+        step = numpy.clip(world.velocity[:, axis] * dt, -31, 31)
+        moving = numpy.flatnonzero(alive & (step != 0))
+        if not len(moving):
+            continue
+        position = world.position[moving]
+        size = world.size[moving]
+        position[:, axis] += step[moving]
+        inside = numpy.clip(position[:, axis], 0, bounds[axis] - size[:, axis])
+        hit = inside != position[:, axis]
+        position[:, axis] = inside
+
+        solid = world.flags[moving] & SOLID > 0
+        forward = step[moving] > 0
+        if solid.any():
+            walls = numpy.zeros(len(moving), dtype=bool)
+            left = numpy.floor(position).astype(numpy.int32)
+            right = left + size - 1
+            for corner_x in (left[:, 0], right[:, 0]):
+                for corner_y in (left[:, 1], right[:, 1]):
+                    walls |= solid & level.walls_at(corner_x // 32,
+                        corner_y // 32)
+
+            # stop right against the wall
+            cell = numpy.where(forward, right[:, axis], left[:, axis]) // 32
+            stopped = numpy.where(forward, cell * 32 - size[:, axis],
+                cell * 32 + 32)
+            position[walls, axis] = stopped[walls]
+            hit |= walls
+
+        rebound = hit & (world.flags[moving] & REBOUND > 0)
+        velocity = world.velocity[moving, axis]
+        velocity[hit] = 0
+        velocity[rebound] = -world.velocity[moving[rebound], axis]
+        world.velocity[moving, axis] = velocity
+        world.flags[moving[hit]] |= (BLOCKED_X, BLOCKED_Y)[axis]
+        if axis == 1:
+            world.flags[moving[hit & forward]] |= RESTING
+        world.position[moving] = position
+
+def animation_system(world, dt, game):
+    """
+    Walk animations play while entities move, they keep their frame when
+    they stop
+    """
+    rows = world.alive() & (world.velocity != 0).any(1)
+    elapsed = world.time - world.animation_start[rows]
+    world.frame[rows] = (elapsed / world.frame_time[rows]).astype(int) % 3
+
+def sound_system(world, dt, game):
+    """
+    Kinds with a hit sound play it when some of their entities hit a wall,
+    once per update
+    """
+    hit = world.alive() & (world.flags & (BLOCKED_X | BLOCKED_Y) > 0)
+    for index in numpy.unique(world.kind[hit]):
+        sound = world.kinds[index].hit_sound
+        if sound is not None:
+            audio.play(sound, game.time)
+
+# the systems moving and animating entities, in order
+SYSTEMS = [gravity_system, movement_system, sound_system, animation_system]
@@ -17,7 +17,8 @@ class Entity(pygame.sprite.Sprite):
         self.attack = None
         self.sound_fx = None
 
-        self.tileset = pygame.image.load(resources.getImage(name))
+        self.name = name
+        self.tileset = resources.loadImage(resources.getImage(name))
         self.direction = RIGHT
         self.solid = True
         self.resting = False
@@ -7,6 +7,9 @@ class Displacement(object):
     And how to react to collisions
     """
 
+    # pixels per second
+    gravity = 300
+
     def __init__(self, entity, game):
         self.entity = entity
         self.h_speed = 200
@@ -21,7 +24,7 @@ class Displacement(object):
     def move(self, xoffset, yoffset, colliding_sprites):
         pass
 
-    def apply_gravity(self):
+    def apply_gravity(self, delta_time):
         pass
 
 class BaseDisplacement(Displacement):
@@ -47,31 +50,39 @@ class BaseDisplacement(Displacement):
         collided_sprites = []
         if xoffset != 0 or yoffset != 0 :
             if xoffset != 0 :
+                origin = self.entity.rect.copy()
                 self.entity.rect.x += xoffset
                 if self.entity.rect.right > level_h_size -1:
                     self.entity.rect.right = level_h_size -1
                 if self.entity.rect.left < 0:
                     self.entity.rect.left = 1
-                collided_sprites = self.collide(xoffset, 0, colliding_sprites)
+                collided_sprites = self.collide(xoffset, 0, colliding_sprites,
+                    origin)
             if yoffset != 0 :
+                origin = self.entity.rect.copy()
                 self.entity.rect.y += yoffset
                 if self.entity.rect.bottom > level_v_size -1:
                     self.entity.rect.bottom = level_v_size -1
                     self.entity.resting = True
                 if self.entity.rect.top < 0:
                     self.entity.rect.top = 1
-                collided_sprites += self.collide(0, yoffset, colliding_sprites)
+                collided_sprites += self.collide(0, yoffset, colliding_sprites,
+                    origin)
 
         # Launch callbacks for touched sprites
         for sprite in collided_sprites :
             self.entity.touched_by(sprite)
 
-    def collide(self, xoffset, yoffset, colliding_sprites):
+    def collide(self, xoffset, yoffset, colliding_sprites, origin=None):
         """
         Check if the entity collided with the provided spritegroup
 
         We use the xoffset and yoffset values for some advanced detection
 
+        When colliding_sprites are the blockers of the current level, only the
+        level cells under the rect swept from origin (the entity rect before
+        displacement) are checked, so fast entities can't go through walls.
+
         Return a list of sprites colliding with self.entity
         """
         # utility vars
@@ -86,10 +97,25 @@ class BaseDisplacement(Displacement):
         sprite = None
         topbottom = False
         leftright = False
-        collided_sprites = pygame.sprite.spritecollide(entity,
-            colliding_sprites,
-            False,
-            pygame.sprite.collide_rect)
+        level = self.game.current_level
+        if colliding_sprites is level.blockers:
+            swept = entity.rect
+            if origin is not None:
+                swept = entity.rect.union(origin)
+            collided_sprites = level.blockers_in(swept)
+            # React to the farthest blockers first, the nearest one is where
+            # the entity ends up
+            if xoffset != 0:
+                collided_sprites.sort(key=lambda sprite: sprite.rect.x,
+                    reverse=xoffset > 0)
+            else:
+                collided_sprites.sort(key=lambda sprite: sprite.rect.y,
+                    reverse=yoffset > 0)
+        else:
+            collided_sprites = pygame.sprite.spritecollide(entity,
+                colliding_sprites,
+                False,
+                pygame.sprite.collide_rect)
 
         for sprite in collided_sprites:
             if  entity.rect.x < (sprite.rect.right + entity.rect.width) and \
@@ -136,8 +162,8 @@ class BaseDisplacement(Displacement):
             if xoffset < 0:
                 self.entity.rect.left = sprite.rect.right + 1
 
-    def apply_gravity(self):
-        self.entity.vector[1] += 10
+    def apply_gravity(self, delta_time):
+        self.entity.vector[1] += self.gravity * delta_time
 
 class ReboundDisplacement(BaseDisplacement):
     """
@@ -0,0 +1,117 @@
+import csv
+import time
+
+import numpy
+import pygame
+
+class FrameProfiler(object):
+    """
+    Times the phases of each frame into a ring buffer holding the last size
+    frames
+
+    A frame goes begin_frame(), mark(phase) after each phase (several marks
+    of the same phase add up) and end_frame(). Recording is a handful of
+    clock reads and list stores per frame, the statistics are only computed
+    when the overlay is drawn or the buffer dumped.
+    """
+
+    def __init__(self, phases, size=300, budget=1./30):
+        self.phases = list(phases)
+        self.columns = dict((phase, i) for (i, phase) in enumerate(phases))
+        self.size = size
+        # last column is the whole frame
+        self.samples = [[0.] * (len(phases) + 1) for i in range(size)]
+        self.count = 0
+        self.row = self.samples[0]
+        self.budget = budget
+        self.visible = False
+        self.font = None
+        self.clock = time.time
+        self.frame_start = self.last = self.clock()
+
+    def begin_frame(self):
+        self.row = self.samples[self.count % self.size]
+        for i in range(len(self.row)):
+            self.row[i] = 0.
+        self.frame_start = self.last = self.clock()
+
+    def mark(self, phase):
+        now = self.clock()
+        self.row[self.columns[phase]] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        self.row[-1] = self.clock() - self.frame_start
+        self.count += 1
+
+    def history(self):
+        """
+        Return the recorded frames, oldest first, as a (frames, phases + 1)
+        array of seconds
+        """
+        if self.count <= self.size:
+            rows = self.samples[:self.count]
+        else:
+            start = self.count % self.size
+            rows = self.samples[start:] + self.samples[:start]
+        return numpy.array(rows).reshape(len(rows), len(self.phases) + 1)
+
+    def stats(self):
+        """
+        Return the averages and 95th percentiles of each phase and of the
+        whole frame
+        """
+        history = self.history()
+        if not len(history):
+            zeros = numpy.zeros(len(self.phases) + 1)
+            return (zeros, zeros)
+        return (history.mean(axis=0), numpy.percentile(history, 95, axis=0))
+
+    def dump_csv(self, filename):
+        history = self.history()
+        first = self.count - len(history)
+        with open(filename, 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['frame'] + self.phases + ['total'])
+            for (i, row) in enumerate(history):
+                writer.writerow([first + i] +
+                    ['%.3f' % (value * 1000) for value in row])
+
+    def draw(self, surface, position=(4, 44)):
+        """
+        Draw rolling averages, 95th percentiles (in ms) and a graph of the
+        frame times
+        """
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+        (averages, p95) = self.stats()
+        names = self.phases + ['frame']
+        (width, line_height, graph_height) = (240, 15, 60)
+        panel = pygame.Surface((width,
+            line_height * (len(names) + 1) + graph_height + 12))
+        panel.set_alpha(200)
+        color = (255,255,255)
+
+        for (column, text) in ((4, 'phase'), (150, 'avg'), (200, 'p95')):
+            panel.blit(self.font.render(text, True, color), (column, 4))
+        for (i, name) in enumerate(names):
+            y = 4 + line_height * (i + 1)
+            panel.blit(self.font.render(name, True, color), (4, y))
+            panel.blit(self.font.render('%.2f' % (averages[i] * 1000), True,
+                color), (150, y))
+            panel.blit(self.font.render('%.2f' % (p95[i] * 1000), True,
+                color), (200, y))
+
+        # frame times graph, the budget line is half way up
+        top = panel.get_height() - graph_height - 4
+        bottom = top + graph_height
+        frames = self.history()[-(width - 8):, -1]
+        scale = graph_height / (2 * self.budget)
+        pygame.draw.line(panel, (255,0,0), (4, bottom - graph_height / 2),
+            (width - 4, bottom - graph_height / 2))
+        if len(frames) > 1:
+            pygame.draw.lines(panel, (0,255,0), False, [
+                (4 + i, bottom - min(frame * scale, graph_height))
+                for (i, frame) in enumerate(frames)])
+
+        surface.blit(panel, position)
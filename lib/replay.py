@@ -0,0 +1,119 @@
+"""
+Recording and replay of the input stream of a game
+
+A recording is a header (magic, format version, seed, tick rate and whether
+the game was started right away) followed by, for each simulation tick, the
+number of events processed before it and these events. Only the event types
+the game listens to are kept, packed in a few bytes each.
+"""
+import pygame
+import struct
+
+MAGIC = 'LD29REC\0'
+VERSION = 1
+HEADER = '<IIIB'
+
+# recorded event types, their position in this list is their code
+EVENT_TYPES = [pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP,
+    pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEMOTION]
+
+def encode(event):
+    """
+    Return the bytes of event, None if it is not recorded
+    """
+    if event.type not in EVENT_TYPES:
+        return None
+    code = struct.pack('<B', EVENT_TYPES.index(event.type))
+    if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+        return code + struct.pack('<iH', event.key, event.mod)
+    if event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+        return code + struct.pack('<hhB', event.pos[0], event.pos[1],
+            event.button)
+    if event.type == pygame.MOUSEMOTION:
+        buttons = sum(bool(button) << i
+            for (i, button) in enumerate(event.buttons))
+        return code + struct.pack('<hhhhB', event.pos[0], event.pos[1],
+            event.rel[0], event.rel[1], buttons)
+    return code
+
+def decode(data, offset):
+    """
+    Return the event at offset in data and the offset of the next one
+    """
+    event_type = EVENT_TYPES[ord(data[offset])]
+    offset += 1
+    if event_type in (pygame.KEYDOWN, pygame.KEYUP):
+        (key, mod) = struct.unpack_from('<iH', data, offset)
+        return (pygame.event.Event(event_type, key=key, mod=mod,
+            unicode=u'', scancode=0), offset + 6)
+    if event_type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+        (x, y, button) = struct.unpack_from('<hhB', data, offset)
+        return (pygame.event.Event(event_type, pos=(x, y), button=button),
+            offset + 5)
+    if event_type == pygame.MOUSEMOTION:
+        (x, y, rx, ry, buttons) = struct.unpack_from('<hhhhB', data, offset)
+        return (pygame.event.Event(event_type, pos=(x, y), rel=(rx, ry),
+            buttons=tuple((buttons >> i) & 1 for i in range(3))), offset + 9)
+    return (pygame.event.Event(event_type), offset)
+
+class InputRecorder(object):
+    """
+    Write the events processed before each tick to a recording
+    """
+    def __init__(self, filename, seed, tick_rate, started=False):
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(struct.pack(HEADER, VERSION, seed, tick_rate,
+            started))
+        self.pending = []
+
+    def add_events(self, events):
+        for event in events:
+            data = encode(event)
+            if data is not None:
+                self.pending.append(data)
+
+    def end_tick(self):
+        """
+        Record the events added since the last tick, they come before this
+        one
+        """
+        self.file.write(struct.pack('<H', len(self.pending)))
+        self.file.write(''.join(self.pending))
+        self.pending = []
+
+    def close(self):
+        self.file.close()
+
+class InputReplay(object):
+    """
+    Read back a recording, one tick at a time
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as replay_file:
+            data = replay_file.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not an input recording' % filename)
+        (version, self.seed, self.tick_rate, started) = struct.unpack_from(
+            HEADER, data, len(MAGIC))
+        if version != VERSION:
+            raise ValueError('%s: unsupported recording version %d' % (
+                filename, version))
+        self.started = bool(started)
+        self.data = data
+        self.offset = len(MAGIC) + struct.calcsize(HEADER)
+
+    def next_events(self):
+        """
+        Return the events to process before the next tick, None at the end of
+        the recording
+        """
+        if self.offset >= len(self.data):
+            return None
+        (count,) = struct.unpack_from('<H', self.data, self.offset)
+        self.offset += 2
+        events = []
+        for i in range(count):
+            (event, self.offset) = decode(self.data, self.offset)
+            events.append(event)
+        return events
@@ -1,5 +1,6 @@
 __author__ = 'benoit'
 
+import pygame
 import yaml
 try:
     from yaml import CLoader as Loader
@@ -49,6 +50,91 @@ def getValue(resource):
 
     return value
 
+class AssetCache(object):
+    """
+    Images and sounds loaded from disk, shared by everyone asking for the same
+    file with the same options
+
+    Images are converted to the display format as soon as a display mode is
+    set, keeping their transparency if they have one. Sounds are only
+    loaded once the mixer is initialised, None is returned before that.
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.sounds = {}
+        self.hits = 0
+        self.misses = 0
+
+    def image(self, filename, convert=True):
+        key = (filename, convert)
+        image = self.images.get(key, None)
+        if image is None:
+            self.misses += 1
+            image = pygame.image.load(filename)
+            converted = False
+        else:
+            self.hits += 1
+            (image, converted) = image
+
+        if convert and not converted and pygame.display.get_surface():
+            # colorkeys of palette images don't survive convert() when the
+            # palette holds the key color twice, go per-pixel alpha instead
+            if (image.get_flags() & pygame.SRCALPHA or
+                    image.get_colorkey() is not None):
+                image = image.convert_alpha()
+            else:
+                image = image.convert()
+            converted = True
+
+        self.images[key] = (image, converted)
+        return image
+
+    def sound(self, filename):
+        if pygame.mixer.get_init() is None:
+            return None
+
+        sound = self.sounds.get(filename, None)
+        if sound is None:
+            self.misses += 1
+            sound = pygame.mixer.Sound(filename)
+            self.sounds[filename] = sound
+        else:
+            self.hits += 1
+        return sound
+
+    def preload(self, *resnames):
+        """
+        Load the images of the resources named
+
+        Sounds are preloaded by lib.sounds.AudioManager
+        """
+        for resname in resnames:
+            image = getObject(resname).get('image', None)
+            if image:
+                self.image(image)
+
+    def clear(self):
+        self.images.clear()
+        self.sounds.clear()
+
+assets = AssetCache()
+
+def loadImage(filename, convert=True):
+    """
+    Return the shared, display converted, surface for filename
+    """
+    return assets.image(filename, convert)
+
+def loadSound(filename):
+    """
+    Return the shared Sound for filename, None if the mixer is not available
+    """
+    return assets.sound(filename)
+
+def preload(*resnames):
+    assets.preload(*resnames)
+
 if __name__ == '__main__':
     print getImage('player')
     print getValue('player.start')
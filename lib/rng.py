@@ -0,0 +1,9 @@
+"""
+The random source of the simulation
+
+Level generation, bonuses, worm spawning and AI all draw from rng. Games seed
+it when they start, so a session can be reproduced from its seed and inputs.
+"""
+import random
+
+rng = random.Random()
@@ -2,19 +2,143 @@ import pygame
 
 import resources
 
+class SoundEntry(object):
+    """
+    A preloaded sound and its playback settings
+    """
+    def __init__(self, name, sound, voices=1, priority=0, cooldown=0):
+        self.name = name
+        self.sound = sound
+        self.voices = voices
+        self.priority = priority
+        # seconds of simulated time
+        self.cooldown = cooldown
+        self.last_played = None
+
+class AudioManager(object):
+    """
+    Plays the sounds declared in the 'sounds' section of resources.yaml over a
+    pool of reserved mixer channels
+
+    Each sound has a maximum number of simultaneous voices (the oldest one is
+    restarted when exceeded), a priority (a busy pool gives up its oldest,
+    lowest priority voice for a higher or equal priority sound) and a cooldown
+    during which new requests are dropped.
+
+    Everything is a no-op when the mixer is not initialised.
+    """
+
+    def __init__(self, channels=8):
+        self.enabled = False
+        self.pool_size = channels
+        self.channels = []
+        self.sounds = {}
+
+    def init(self):
+        self.enabled = pygame.mixer.get_init() is not None
+        if not self.enabled:
+            return
+
+        if pygame.mixer.get_num_channels() < self.pool_size:
+            pygame.mixer.set_num_channels(self.pool_size)
+        # keep the pool for ourselves, Sound.play() won't pick these
+        pygame.mixer.set_reserved(self.pool_size)
+        self.channels = [pygame.mixer.Channel(i)
+            for i in range(self.pool_size)]
+        self.playing = [None] * self.pool_size
+        self.started = [0] * self.pool_size
+        self.preload()
+
+    def preload(self):
+        for (name, conf) in resources.getObject('sounds').items():
+            try:
+                sound = resources.loadSound(conf['file'])
+            except (IOError, pygame.error), error:
+                print "Can't load sound %s: %s" % (name, error)
+                sound = None
+            self.sounds[name] = SoundEntry(name, sound,
+                conf.get('voices', 1), conf.get('priority', 0),
+                conf.get('cooldown', 0))
+
+    def play(self, name, time):
+        """
+        Play the sound called name at time, the game simulated time in
+        seconds, return the channel used or None if the request was dropped
+
+        Cooldowns follow the simulated time, so headless and replayed games
+        drop the same sounds as played ones.
+        """
+        if not self.enabled:
+            return None
+        entry = self.sounds.get(name, None)
+        if entry is None or entry.sound is None:
+            return None
+
+        # a clock going back (a new game) ends the cooldown
+        if (entry.last_played is not None and
+                entry.last_played <= time < entry.last_played +
+                entry.cooldown):
+            return None
+
+        voices = 0
+        oldest_voice = None
+        free = None
+        victim = None
+        for i in range(self.pool_size):
+            if not self.channels[i].get_busy():
+                self.playing[i] = None
+                if free is None:
+                    free = i
+                continue
+            playing = self.playing[i]
+            if playing is entry:
+                voices += 1
+                if (oldest_voice is None or
+                        self.started[i] < self.started[oldest_voice]):
+                    oldest_voice = i
+            if playing is None or playing.priority > entry.priority:
+                continue
+            # the lowest priority then oldest voice is given up first
+            if victim is None:
+                victim = i
+                continue
+            lowest = self.playing[victim]
+            if (playing.priority < lowest.priority or
+                    (playing.priority == lowest.priority and
+                    self.started[i] < self.started[victim])):
+                victim = i
+
+        if voices >= entry.voices:
+            index = oldest_voice
+        elif free is not None:
+            index = free
+        else:
+            index = victim
+        if index is None:
+            return None
+
+        channel = self.channels[index]
+        channel.play(entry.sound)
+        self.playing[index] = entry
+        self.started[index] = time
+        entry.last_played = time
+        return channel
+
+    def stop(self):
+        for channel in self.channels:
+            channel.stop()
+
+audio = AudioManager()
+
 class SoundFx(object):
 
     def __init__(self, name):
-        self.enabled = pygame.mixer.get_init() is not None
+        self.enabled = audio.enabled
         self.sounds = {
-            'hit':pygame.mixer.Sound(resources.getValue('%s.hitsound' % (name))),
+            'hit':resources.getValue('%s.hitsound' % (name)),
         }
 
-    def play_sound(self, sound):
+    def play_sound(self, sound, time):
         sound = self.sounds.get(sound, None)
         if sound:
-            # chan = pygame.mixer.find_channel()
-            # if chan :
-            #     chan.play(sound)
-            sound.stop()
-            sound.play()
+            audio.play(sound, time)
@@ -0,0 +1,85 @@
+import pygame
+
+class TextCache(object):
+    """
+    Rendered surfaces of a font, by text, color and antialiasing
+
+    Meant for strings that come back (titles, messages), the cache is emptied
+    once it holds more than size entries.
+    """
+
+    def __init__(self, font, size=64):
+        self.font = font
+        self.size = size
+        self.texts = {}
+
+    def render(self, text, color=(255,255,255), antialias=False):
+        key = (text, color, antialias)
+        surface = self.texts.get(key, None)
+        if surface is None:
+            if len(self.texts) >= self.size:
+                self.texts.clear()
+            surface = self.font.render(text, antialias, color)
+            self.texts[key] = surface
+        return surface
+
+class GlyphAtlas(object):
+    """
+    Pre-rendered glyphs of a font, to compose strings made of those characters
+    (digits by default) without rasterising them again
+    """
+
+    def __init__(self, font, chars='0123456789:', color=(255,255,255),
+            antialias=False):
+        self.glyphs = dict((char, font.render(char, antialias, color))
+            for char in chars)
+        self.height = max(glyph.get_height() for glyph in self.glyphs.values())
+
+    def can_render(self, text):
+        for char in text:
+            if char not in self.glyphs:
+                return False
+        return True
+
+    def size(self, text):
+        return (sum(self.glyphs[char].get_width() for char in text),
+            self.height)
+
+    def blits(self, text, position=(0, 0)):
+        """
+        Return the (glyph, position) list drawing text at position
+        """
+        (x, y) = position
+        blits = []
+        for char in text:
+            glyph = self.glyphs[char]
+            blits.append((glyph, (x, y)))
+            x += glyph.get_width()
+        return blits
+
+    def render(self, text):
+        surface = pygame.Surface(self.size(text), pygame.SRCALPHA)
+        surface.blits(self.blits(text), False)
+        return surface
+
+class CachedText(object):
+    """
+    A line of text whose surface is only rendered again when its value
+    changes, composed from glyphs when they are all in the atlas given
+    """
+
+    def __init__(self, font, color=(255,255,255), glyphs=None):
+        self.font = font
+        self.color = color
+        self.glyphs = glyphs
+        self.text = None
+        self.surface = None
+
+    def render(self, text):
+        if text != self.text:
+            self.text = text
+            if self.glyphs and self.glyphs.can_render(text):
+                self.surface = self.glyphs.render(text)
+            else:
+                self.surface = self.font.render(text, False, self.color)
+        return self.surface
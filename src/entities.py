@@ -3,11 +3,11 @@ import pygame
 
 from lib import resources
 from lib.utils import UP, DOWN, LEFT, RIGHT
-from lib.animations import EntityAnimation, StaticAnimation
-from lib.physics import BaseDisplacement, ReboundDisplacement
-from lib.ai import WandererBrain, DumbBrain
+from lib.animations import EntityAnimation
+from lib.physics import BaseDisplacement
+from lib.ai import DumbBrain
+from lib.ecs import EntityKind, REBOUND, SOLID, WANDERER
 from lib.entities import Entity
-from lib.sounds import SoundFx
 
 class Bullet(pygame.sprite.Sprite):
     """
@@ -15,7 +15,7 @@ class Bullet(pygame.sprite.Sprite):
     """
     def __init__(self, direction, firepos, *groups):
         super(Bullet, self).__init__(*groups)
-        self.image = pygame.image.load(resources.getImage('bullet'))
+        self.image = resources.loadImage(resources.getImage('bullet'))
 
         self.rect = firepos
         self.direction = direction
@@ -32,61 +32,45 @@ class Bullet(pygame.sprite.Sprite):
         if self.direction == DOWN:
             self.rect.y += self.speed * dt
 
-class Arrow(Entity):
+# kinds of the array backed entities, loaded on first use
+KINDS = {}
+
+def enemy_kind(name):
+    kind = KINDS.get(name, None)
+    if kind is None:
+        kind = EntityKind.from_resources(name, flags=SOLID | WANDERER)
+        KINDS[name] = kind
+    return kind
+
+def arrow_kind():
+    kind = KINDS.get('bullet', None)
+    if kind is None:
+        image = resources.loadImage(resources.getImage('bullet'))
+        frames = dict((direction, [image] * 3)
+            for direction in (UP, DOWN, LEFT, RIGHT))
+        kind = EntityKind('bullet', frames, (16, 16), 300, SOLID | REBOUND)
+        KINDS['bullet'] = kind
+    return kind
+
+def spawn_enemy(game, name, position, direction=RIGHT):
     """
-    A projectile with an origin and an attack target used to compute its
-    direction
+    Add an enemy walking around to game.mobs, return its row
     """
+    return game.mobs.spawn(enemy_kind(name), position, direction)
 
-    def __init__(self, origin, atkpos, game, *groups):
-        super(Arrow, self).__init__('bullet', *groups)
-
-        self.animation = StaticAnimation(self)
-        self.displacement = ReboundDisplacement(self)
-        self.displacement.set_speed(300)
-
-        self.rect = pygame.Rect((origin.x, origin.y), (16, 16))
-
-        self.solid_objects = game.current_level.blockers
-
-        distance = math.sqrt(
-                    math.pow(320 - atkpos[0], 2) +
-                    math.pow(240 - atkpos[1], 2)
-                    )
-
-        self.vector = [
-            (atkpos[0] - 320)/distance * self.displacement.h_speed,
-            (atkpos[1] - 240)/distance * self.displacement.v_speed,
-            ]
-
-        self.sound_fx = SoundFx('bullet')
-
-    def move(self, delta_time, game):
-        vector = self.vector[:]
-        vector[0] *= delta_time
-        vector[1] *= delta_time
-        self.displacement.move(vector[0], vector[1], self.solid_objects)
-
-    def touched_by(self, entities):
-        self.sound_fx.play_sound('hit')
-
-class Enemy(Entity):
-
-    def __init__(self, name, *groups):
-        super(Enemy, self).__init__(name, *groups)
-
-        self.animation = EntityAnimation(self)
-        self.displacement = BaseDisplacement(self)
-        self.displacement.set_speed(resources.getValue('%s.speed' % name))
-        self.brain = WandererBrain(self)
-
-    def move(self, delta_time, game):
-        self.displacement.move(self.vector[0], self.vector[1],
-            game.current_level.blockers)
-
-    def touched_by(self, sprite):
-        if sprite and self.brain:
-            self.brain.touched_by(sprite)
+def spawn_arrow(game, origin, atkpos):
+    """
+    Add an arrow shot from origin towards atkpos, the screen position aimed
+    at, to game.mobs, return its row
+    """
+    kind = arrow_kind()
+    distance = math.sqrt(
+                math.pow(320 - atkpos[0], 2) +
+                math.pow(240 - atkpos[1], 2)
+                )
+    velocity = ((atkpos[0] - 320)/distance * kind.speed,
+        (atkpos[1] - 240)/distance * kind.speed)
+    return game.mobs.spawn(kind, (origin.x, origin.y), velocity=velocity)
 
 class PlayerControlledBrain(DumbBrain):
 
@@ -134,8 +118,8 @@ class PlayerControlledBrain(DumbBrain):
         atkpos.x += 8
         atkpos.y += 10
         self.entity.vector = [0,0]
-        self.dig_delay -= 1
-        self.jump_delay -= 1
+        self.dig_delay -= delta_time
+        self.jump_delay -= delta_time
         for key in self.key_pressed:
             if key in (pygame.K_LEFT, pygame.K_a, pygame.K_q):
                 self.entity.vector[0] = -self.entity.h_speed * delta_time
@@ -146,27 +130,31 @@ class PlayerControlledBrain(DumbBrain):
             if key in (pygame.K_UP, pygame.K_z, pygame.K_w):
                 self.entity.direction = UP
                 if self.jump_delay <= 0 and self.entity.resting:
-                    self.jump_delay = 0.3*30
+                    self.jump_delay = 0.3
             if key in (pygame.K_DOWN, pygame.K_s):
                 # self.entity.vector[1] = +self.entity.v_speed * delta_time
                 self.entity.direction = DOWN
 
         # process attacks
         if 1 in self.button_pressed and self.dig_delay < 0:
-            self.dig_delay = 15
+            self.dig_delay = 0.5
 
 
 class Player(Entity):
 
+    # pixels per second
+    jump_speed = 600
+
     def __init__(self, game, *groups):
         super(Player, self).__init__('player', *groups)
         self.solid = True
 
         self.brain = PlayerControlledBrain(self)
         self.game = game
-        game.event_listener.register_listener(self.brain, pygame.KEYDOWN)
-        game.event_listener.register_listener(self.brain,
-            pygame.MOUSEBUTTONDOWN)
+        for event_type in (pygame.KEYDOWN, pygame.KEYUP,
+                pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP,
+                pygame.MOUSEMOTION):
+            game.event_listener.register_listener(self.brain, event_type)
 
         self.animation = EntityAnimation(self)
         self.rect = pygame.Rect((0,0), (16,24))
@@ -231,16 +219,16 @@ class Player(Entity):
                 )
             if block_distance >= 2.5:
                 return
-            dig_ent = self.game.current_level.sprites[dig_x, dig_y]
+            dig_ent = self.game.current_level.tile(dig_x, dig_y)
             self.dig(dig_ent)
         # digged will remain true until digging switch back to false
 
 
     def move(self, delta_time, game):
         if self.jumping:
-            self.vector[1] -= 20
+            self.vector[1] -= self.jump_speed * delta_time
             self.resting = False
-        self.displacement.apply_gravity()
+        self.displacement.apply_gravity(delta_time)
 
 
 
@@ -1,11 +1,16 @@
 __author__ = 'Anbcorp'
 
+import atexit
+import functools
 import numpy
+import os
 import pygame
-import random
+import shutil
+import tempfile
 
 from lib import resources
 from lib.animations import EffectAnimation
+from lib.rng import rng
 from lib.utils import DIRECTIONS, DOWN, LEFT, RIGHT, UP
 
 class ScrolledGroup(pygame.sprite.LayeredUpdates):
@@ -15,10 +20,13 @@ class ScrolledGroup(pygame.sprite.LayeredUpdates):
     This suppose all sprites for the level are kept in memory
     """
 
-    def __init__(self, *sprites):
-        super(ScrolledGroup, self).__init__(*sprites)
+    def __init__(self, *sprites, **kwargs):
+        super(ScrolledGroup, self).__init__(*sprites, **kwargs)
         self._camera_x = 0
         self._camera_y = 0
+        # positions before the last update, for interpolation
+        self.previous_camera = (0, 0)
+        self.previous = {}
         self.e_time = 0
         self.debug = False
 
@@ -31,7 +39,17 @@ class ScrolledGroup(pygame.sprite.LayeredUpdates):
         self._camera_x = value[0]
         self._camera_y = value[1]
 
+    def moved(self, sprite):
+        """
+        Do not interpolate the position of sprite until the next update, for
+        sprites that jump rather than move
+        """
+        self.previous.pop(sprite, None)
+
     def update(self, dt, game, *args):
+        self.previous_camera = self.camera
+        self.previous = dict((sprite, sprite.rect.topleft)
+            for sprite in self.sprites())
         super(ScrolledGroup, self).update(dt, game, *args)
         self.e_time += dt
         if self.e_time > 1 and self.debug:
@@ -50,16 +68,406 @@ class ScrolledGroup(pygame.sprite.LayeredUpdates):
             cam_y = game.current_level.v_size*32 - 480
         self.camera = (cam_x, cam_y)
 
-    def draw(self, surface):
-        for sprite in self.sprites():
-            try:
-                surface.blit(sprite.image, (
-                    sprite.rect.x - self._camera_x,
-                    sprite.rect.y - self._camera_y)
-                )
-            except Exception as excep:
-                print sprite.image, sprite
-                raise excep
+    def visible_sprites(self, view):
+        """
+        Return the sprites intersecting view (a Rect in level coordinates),
+        in drawing order
+        """
+        return [sprite for sprite in self.sprites()
+            if view.colliderect(sprite.rect)]
+
+    def interpolated_camera(self, alpha=1.):
+        """
+        Return the camera position alpha (0. to 1.) of the way between its
+        positions before and after the last update
+        """
+        return interpolate(self.previous_camera, self.camera, alpha)
+
+    def placed_sprites(self, size, alpha=1.):
+        """
+        Return the (image, screen position) of the sprites visible on a
+        surface of size, alpha interpolates between their positions before and
+        after the last update
+        """
+        (cam_x, cam_y) = self.interpolated_camera(alpha)
+        view = pygame.Rect((cam_x, cam_y), size)
+        previous = self.previous
+        blits = []
+        for sprite in self.visible_sprites(view):
+            (x, y) = sprite.rect.topleft
+            if sprite in previous:
+                (x, y) = interpolate(previous[sprite], (x, y), alpha)
+            blits.append((sprite.image, (x - cam_x, y - cam_y)))
+        return blits
+
+    def screen_rects(self, size, alpha=1.):
+        """
+        Return the screen rects covered by the sprites visible on a surface of
+        size
+        """
+        return [image.get_rect(topleft=position)
+            for (image, position) in self.placed_sprites(size, alpha)]
+
+    def draw(self, surface, alpha=1.):
+        surface.blits(self.placed_sprites(surface.get_size(), alpha),
+            False)
+
+def interpolate(start, end, alpha):
+    """
+    Return the integer position alpha of the way from start to end
+    """
+    if alpha >= 1 or start == end:
+        return end
+    return (int(round(start[0] + (end[0] - start[0]) * alpha)),
+        int(round(start[1] + (end[1] - start[1]) * alpha)))
+
+class TerrainCache(object):
+    """
+    Pre-rendered terrain of a level, baked into chunks of chunk_size x
+    chunk_size tiles
+
+    Chunks are rendered from level.cell_image(x, y) the first time the camera
+    overlaps them and kept until one of their cells is invalidated, or until
+    they are the least recently drawn of more than max_chunks chunks.
+    Invalidated cells are also remembered until pop_touched_rects().
+    """
+
+    def __init__(self, level, chunk_size=8, tile_size=32, max_chunks=64):
+        self.level = level
+        self.chunk_size = chunk_size
+        self.tile_size = tile_size
+        self.max_chunks = max_chunks
+        self.chunks = {}
+        self.used = {}
+        self.frame = 0
+        self.touched = set()
+
+    def invalidate(self, x, y):
+        self.drop((x // self.chunk_size, y // self.chunk_size))
+        self.touched.add((x, y))
+
+    def drop(self, key):
+        self.chunks.pop(key, None)
+        self.used.pop(key, None)
+
+    def forget_rows(self, top, bottom):
+        """
+        Drop the chunks overlapping rows [top, bottom)
+        """
+        for cy in range(top // self.chunk_size,
+                (bottom - 1) // self.chunk_size + 1):
+            for cx in range((self.level.h_size - 1) // self.chunk_size + 1):
+                self.drop((cx, cy))
+
+    def pop_touched_rects(self):
+        size = self.tile_size
+        rects = [pygame.Rect(x * size, y * size, size, size)
+            for (x, y) in self.touched]
+        self.touched.clear()
+        return rects
+
+    def clear(self):
+        self.chunks.clear()
+        self.used.clear()
+
+    def render_chunk(self, cx, cy):
+        (size, tile_size) = (self.chunk_size, self.tile_size)
+        (x_min, y_min) = (cx * size, cy * size)
+        x_max = min(x_min + size, self.level.h_size)
+        y_max = min(y_min + size, self.level.v_size)
+
+        chunk = pygame.Surface(((x_max - x_min) * tile_size,
+            (y_max - y_min) * tile_size))
+        blits = []
+        for y in range(y_min, y_max):
+            for x in range(x_min, x_max):
+                image = self.level.cell_image(x, y)
+                if image is not None:
+                    blits.append((image,
+                        ((x - x_min) * tile_size, (y - y_min) * tile_size)))
+        chunk.blits(blits, False)
+        return chunk
+
+    def draw(self, surface, camera):
+        (cam_x, cam_y) = camera
+        (width, height) = surface.get_size()
+        span = self.chunk_size * self.tile_size
+        cx_max = min((cam_x + width - 1) // span + 1,
+            (self.level.h_size - 1) // self.chunk_size + 1)
+        cy_max = min((cam_y + height - 1) // span + 1,
+            (self.level.v_size - 1) // self.chunk_size + 1)
+
+        self.frame += 1
+        blits = []
+        for cy in range(max(cam_y // span, 0), cy_max):
+            for cx in range(max(cam_x // span, 0), cx_max):
+                chunk = self.chunks.get((cx, cy))
+                if chunk is None:
+                    chunk = self.render_chunk(cx, cy)
+                    self.chunks[(cx, cy)] = chunk
+                self.used[(cx, cy)] = self.frame
+                blits.append((chunk, (cx * span - cam_x, cy * span - cam_y)))
+        surface.blits(blits, False)
+
+        if len(self.chunks) > self.max_chunks:
+            for key in sorted(self.chunks, key=self.used.get)[
+                    :len(self.chunks) - self.max_chunks]:
+                del self.chunks[key]
+                del self.used[key]
+
+# Assign a bit for each tile surrounding
+# | 128 |   1 |   2 |
+# |  64 | til |   4 |
+# |  32 |  16 |   8 |
+#
+# (dx, dy, bit) for each neighbour
+NEIGHBOURS = (
+    ( 0, -1, 0), ( 1, -1, 1), ( 1,  0, 2), ( 1,  1, 3),
+    ( 0,  1, 4), (-1,  1, 5), (-1,  0, 6), (-1, -1, 7),
+)
+
+def neighbour_masks(level):
+    """
+    Return the 8 bits mask of the empty surroundings of every cell of level
+    (a 2D array indexed [x, y], non zero for empty cells) as an uint8 array
+
+    Cells out of the level count as filled.
+    """
+    (h_size, v_size) = level.shape
+    padded = numpy.zeros((h_size + 2, v_size + 2), dtype=numpy.uint8)
+    padded[1:-1, 1:-1] = level != 0
+
+    masks = numpy.zeros((h_size, v_size), dtype=numpy.uint8)
+    for (dx, dy, bit) in NEIGHBOURS:
+        masks |= padded[1+dx:h_size+1+dx, 1+dy:v_size+1+dy] << bit
+    return masks
+
+def quadrant_codes(masks):
+    """
+    Split neighbour masks into the NW, NE, SE and SW quadrant codes used to
+    pick the corners of a wall tile
+
+    Works on a single mask as well as on arrays of masks.
+    """
+    # for each quadrant of our tile, the surroudings are represented by values
+    return (masks & 0b11000001, masks & 0b00000111,
+        masks & 0b00011100, masks & 0b01110000)
+
+def quadrant_blocks(qNW, qNE, qSE, qSW):
+    """
+    Return the names of the NW, NE, SE and SW blocks to use for a wall tile
+    from its quadrant codes
+    """
+    # O is empty (==1)
+    # X is filled (==0)
+    # add the values for Os
+
+    # for the NW quadrant (x is our tile, O is empty, X is
+    # filled)
+    if qNW == 193 or qNW == 65:
+        # OO XO
+        # Ox Ox
+        tNW = 'NW'
+    elif qNW == 1 or qNW == 129:
+        # OO XO
+        # Xx Xx
+        tNW = 'N1'
+    elif qNW == 192 or qNW == 64:
+        # OX XX
+        # Ox Ox
+        tNW = 'W1'
+    elif qNW == 128:
+        # OX
+        # Xx
+        tNW = 'iNW'
+    else:
+        # XX
+        # Xx
+        tNW = 'mNW'
+
+    if qNE == 7 or qNE == 5:
+        # 111
+        # OO OX
+        # xO xO
+        tNE = 'NE'
+    elif qNE == 3 or qNE == 1:
+        # OO OX
+        # xX xX
+        tNE = 'N2'
+    elif qNE == 6 or qNE == 4:
+        # XO XX
+        # xO xO
+        tNE = 'E1'
+    elif qNE == 2:
+        # X0
+        # xX
+        tNE = 'iNE'
+    else:
+        # XX
+        # xX
+        tNE = 'mNE'
+
+    if qSE == 28 or qSE == 20:
+        # 111
+        # xO xO
+        # OO OX
+        tSE = 'SE'
+    elif qSE == 12 or qSE == 4:
+        # xO xO
+        # XO XX
+        tSE = 'E2'
+    elif qSE == 24 or qSE == 16:
+        # xX xX
+        # OO OX
+        tSE = 'S2'
+    elif qSE == 8:
+        # xX
+        # XO
+        tSE = 'iSE'
+    else:
+        # xX
+        # XX
+        tSE = 'mSE'
+
+    if qSW == 112 or qSW == 80:
+        # 111
+        # Ox Ox
+        # OO XO
+        tSW = 'SW'
+    elif qSW == 48 or qSW == 16:
+        # Xx Xx
+        # OO XO
+        tSW = 'S1'
+    elif qSW == 96 or qSW == 64:
+        # Ox Ox
+        # OX XX
+        tSW = 'W2'
+    elif qSW == 32:
+        # Xx
+        # OX
+        tSW = 'iSW'
+    else:
+        # Xx
+        # XX
+        tSW = 'mSW'
+
+    return (tNW, tNE, tSE, tSW)
+
+class TileAtlas(object):
+    """
+    Wall tiles of a tileset, composed and outlined once for each of the 256
+    neighbour masks
+
+    Overlays (bonuses, ...) can be added by name, each giving another set of
+    256 tiles with the overlay blitted over the wall. Atlases are shared
+    between levels using the same tileset, see TileAtlas.get()
+    """
+    atlases = {}
+
+    @classmethod
+    def get(cls, key, blocks):
+        atlas = cls.atlases.get(key, None)
+        if atlas is None:
+            atlas = cls(blocks)
+            cls.atlases[key] = atlas
+        return atlas
+
+    def __init__(self, blocks):
+        # masks sharing the same quadrants share the same surface
+        composed = {}
+        walls = []
+        codes = zip(*quadrant_codes(numpy.arange(256)))
+        for mask in range(256):
+            quadrants = quadrant_blocks(*codes[mask])
+            image = composed.get(quadrants, None)
+            if image is None:
+                image = self.compose(blocks, quadrants)
+                composed[quadrants] = image
+            walls.append(image)
+        self.walls = {None: walls}
+
+    def compose(self, blocks, quadrants):
+        (tNW, tNE, tSE, tSW) = quadrants
+        image = pygame.Surface((32,32))
+        # We blit the smaller tiles into a larger one
+        image.blit(blocks[tNW], (0,0))
+        image.blit(blocks[tNE], (16,0))
+        image.blit(blocks[tSE], (16,16))
+        image.blit(blocks[tSW], (0,16))
+        self.outline(image)
+        return image
+
+    def outline(self, image, color=(0,0,0)):
+        pygame.draw.rect(image, color, image.get_rect(), 1)
+
+    def add_overlay(self, name, overlay):
+        if name in self.walls:
+            return
+        composed = {}
+        walls = []
+        for image in self.walls[None]:
+            key = id(image)
+            if key not in composed:
+                composed[key] = image.copy()
+                composed[key].blit(overlay, (0,0))
+            walls.append(composed[key])
+        self.walls[name] = walls
+
+    def image(self, mask, overlay=None):
+        return self.walls[overlay][mask]
+
+class Tile(object):
+    """
+    A sprite-like view over the cell (x, y) of a MazeLevel
+
+    The level state lives in the level arrays, views are only created for the
+    few cells that need one (collisions, digging).
+    """
+    __slots__ = ('level', 'x', 'y', 'rect')
+
+    def __init__(self, level, x, y):
+        self.level = level
+        self.x = x
+        self.y = y
+        self.rect = pygame.Rect(x*32, y*32, 32, 32)
+
+    @property
+    def image(self):
+        return self.level.cell_image(self.x, self.y)
+
+    @property
+    def mask(self):
+        return int(self.level.masks[self.x, self.y])
+
+    @property
+    def bonus(self):
+        return self.level.bonus_names[self.level.bonus[self.x, self.y]]
+
+    @property
+    def value(self):
+        return int(self.level.value[self.x, self.y])
+
+    @property
+    def hitpoints(self):
+        return int(self.level.hitpoints[self.x, self.y])
+
+class Blockers(object):
+    """
+    The walls of a MazeLevel, seen as a container of Tile views
+    """
+    def __init__(self, level):
+        self.level = level
+
+    def __contains__(self, tile):
+        return (isinstance(tile, Tile) and tile.level is self.level
+            and self.level.level[tile.x, tile.y] == 0)
+
+    def __iter__(self):
+        (xs, ys) = self.level.wall_cells()
+        return (Tile(self.level, x, y) for (x, y) in zip(xs, ys))
+
+    def __len__(self):
+        return len(self.level.wall_cells()[0])
 
 class Level(object):
     """
@@ -82,9 +490,35 @@ class Level(object):
         self.tiles.update(dt, game)
         self.blockers.update(dt, game)
 
-    def draw(self, screen):
-        self.blockers.draw(screen)
-        self.tiles.draw(screen)
+    def blockers_in(self, rect):
+        """
+        Return the blockers intersecting rect
+        """
+        return [sprite for sprite in self.blockers
+            if rect.colliderect(sprite.rect)]
+
+    def draw(self, screen, alpha=1.):
+        self.blockers.draw(screen, alpha=alpha)
+        self.tiles.draw(screen, alpha=alpha)
+
+    def screen_rects(self, size, alpha=1.):
+        """
+        Return the screen rects of the level sprites that may move or change
+        """
+        return (self.blockers.screen_rects(size, alpha=alpha) +
+            self.tiles.screen_rects(size, alpha=alpha))
+
+    def pop_touched_rects(self):
+        """
+        Return the level rects whose terrain changed since the last call
+        """
+        return []
+
+    def close(self):
+        """
+        Release what the level keeps outside of memory, once it is replaced
+        """
+        pass
 
 
 
@@ -97,7 +531,7 @@ class BasicLevel(Level):
         # we use pixels instead of tiles
         h_size = self.h_size*32
         v_size = self.v_size*32
-        tiles = pygame.image.load(resources.getImage('level'))
+        tiles = resources.loadImage(resources.getImage('level'))
         # TODO: load a specific tile from resources
         block = tiles.subsurface(pygame.Rect(6*32,3*32,32,32))
 
@@ -112,7 +546,7 @@ class BasicLevel(Level):
                     wall.image = block
                     wall.rect = pygame.rect.Rect((x,y), block.get_size())
                 else:
-                    if random.randint(0,12) == 0:
+                    if rng.randint(0,12) == 0:
                         tile = pygame.sprite.Sprite(self.blockers)
                         tile.image = block
                     else:
@@ -122,24 +556,158 @@ class BasicLevel(Level):
 
 
 class MazeLevel(Level):
+    """
+    A level whose state is kept in typed arrays indexed by [x, y]: level
+    (terrain, 0 for walls), masks (neighbour masks), bonus (index in
+    bonus_names), hitpoints and value
+
+    Tile surfaces are derived from these arrays by cell_image(), blockers is
+    a Blockers view over the walls and tiles only holds effects.
+    """
+    bonuses = {}
 
     def __init__(self):
         super(MazeLevel, self).__init__()
+        self.blockers = Blockers(self)
+        self.bonus_names = ['None'] + list(self.bonuses)
+        bonuses = [self.bonuses[name] for name in self.bonus_names[1:]]
+        self.bonus_values = numpy.array(
+            [0] + [bonus['value'] for bonus in bonuses], dtype=numpy.int32)
+        self.bonus_hardness = numpy.array(
+            [0] + [bonus['hardness'] for bonus in bonuses], dtype=numpy.int8)
+        self.bonus_odds = self.bonus_depth_table()
         self.set_tiles()
-        self.sprites = numpy.empty( (self.h_size, self.v_size),
-            dtype=pygame.sprite.Sprite)
-        self.select_sprite = pygame.image.load('res/selected.png')
-        self.selected_orig = None
+        self.terrain = TerrainCache(self)
+        # drawn over the selected cell, above the terrain
+        self.highlight = pygame.sprite.Sprite()
+        self.highlight.image = resources.loadImage(
+            resources.getImage('selected'))
+        self.highlight.rect = pygame.Rect(0, 0, 32, 32)
+        self.selected = None
+        self.layout()
+
+    def layout(self):
+        """
+        Compute the neighbour masks and bonuses of the whole level
+        """
+        self.masks = neighbour_masks(self.level)
+        self.bonus = self.place_bonuses(self.level, 0,
+            numpy.random.RandomState(rng.getrandbits(32)))
+        self.hitpoints = self.bonus_hardness[self.bonus]
+        self.value = self.bonus_values[self.bonus]
+        self.terrain.clear()
+
+    def bonus_depth_table(self):
+        """
+        Return the cumulated odds of a wall to get each bonus (columns, in
+        bonus_names[1:] order) by depth (rows), deeper rows are like the last
+        one
+        """
+        names = self.bonus_names[1:]
+        depths = [0]
+        for bonus in self.bonuses.values():
+            depths.extend([bonus['mindepth'], bonus.get('maxdepth', 0) + 1])
+        depth = numpy.arange(max(depths) + 1)
+        odds = numpy.zeros((len(depth), len(names)))
+
+        # one wall out of two gets a bonus draw, where each bonus in turn has
+        # rarity percent chances to be picked, and is only kept if it fits
+        # the depth
+        reached = 0.5
+        for (column, name) in enumerate(names):
+            bonus = self.bonuses[name]
+            chance = bonus['rarity'] / 100.
+            fits = depth >= bonus['mindepth']
+            if bonus.get('maxdepth', 0) > 0:
+                fits &= depth <= bonus['maxdepth']
+            odds[:, column] = reached * chance * fits
+            reached *= 1 - chance
+        return numpy.cumsum(odds, axis=1)
+
+    def place_bonuses(self, level, top, rand):
+        """
+        Return the bonus ids of the walls of level (a block of rows starting at
+        row top), from one draw of rand (a numpy RandomState) per cell
+        """
+        bonus = numpy.zeros(level.shape, dtype=numpy.uint8)
+        if len(self.bonus_names) == 1:
+            return bonus
+        odds = self.bonus_odds
+        depths = numpy.minimum(numpy.arange(top, top + level.shape[1]),
+            len(odds) - 1)
+        draws = rand.random_sample(level.shape)
+        # the bonus whose cumulated odds first exceed the draw, if any
+        ids = (draws[:, :, numpy.newaxis] >=
+            odds[depths][numpy.newaxis, :, :]).sum(axis=2) + 1
+        placed = (level == 0) & (ids < len(self.bonus_names))
+        bonus[placed] = ids[placed]
+        return bonus
+
+    def update(self, dt, game):
+        self.tiles.update(dt, game)
+
+    def draw(self, screen, alpha=1.):
+        self.terrain.draw(screen, self.tiles.interpolated_camera(alpha))
+        self.tiles.draw(screen, alpha=alpha)
+
+    def screen_rects(self, size, alpha=1.):
+        # terrain changes are reported by pop_touched_rects()
+        return self.tiles.screen_rects(size, alpha=alpha)
+
+    def pop_touched_rects(self):
+        return self.terrain.pop_touched_rects()
+
+    def blockers_in(self, rect):
+        """
+        Return the blockers intersecting rect, only looking at the level cells
+        under it
+        """
+        x_min = max(rect.left // 32, 0)
+        x_max = min((rect.right - 1) // 32 + 1, self.h_size)
+        y_min = max(rect.top // 32, 0)
+        y_max = min((rect.bottom - 1) // 32 + 1, self.v_size)
+        if x_min >= x_max or y_min >= y_max:
+            return []
 
-        for y in range(0, self.v_size):
-            for x in range(0, self.h_size):
-                self.autolayout(x, y)
+        (xs, ys) = numpy.nonzero(self.level[x_min:x_max, y_min:y_max] == 0)
+        return [Tile(self, x_min + x, y_min + y) for (x, y) in zip(xs, ys)]
+
+    def wall_cells(self):
+        """
+        Return the (xs, ys) arrays of the wall cells
+        """
+        return numpy.nonzero(self.level == 0)
+
+    def walls_at(self, xs, ys):
+        """
+        Return whether the cells (xs, ys), two arrays, are walls
+        """
+        return self.level[xs, ys] == 0
+
+    def state_arrays(self):
+        """
+        Return the bytes of the level state, for checksums
+        """
+        return [getattr(self, name).tostring()
+            for (name, dtype) in CHUNK_ARRAYS]
+
+    def tile(self, x, y):
+        return Tile(self, x, y)
+
+    def cell_image(self, x, y):
+        if self.level[x, y]:
+            return self.empty_tile
+        bonus = self.bonus[x, y]
+        return self.atlas.image(self.masks[x, y],
+            self.bonus_names[bonus] if bonus else None)
 
     def set_tiles(self):
-        self.tileset = pygame.image.load(resources.getImage('level'))
+        self.tileset = resources.loadImage(resources.getImage('level'))
         # TODO: load a specific tile from resources
         (base_x, base_y) = (4,14)
         self.blocks = self.get_blocks(base_x, base_y)
+        self.atlas = TileAtlas.get(
+            (resources.getImage('level'), base_x, base_y), self.blocks)
         self.empty_tile = self.tileset.subsurface(pygame.Rect(0,0,32,32))
 
     def get_blocks(self, base_x, base_y):
@@ -178,229 +746,256 @@ class MazeLevel(Level):
         v_size = self.v_size
 
 
-        self.level = numpy.zeros((h_size, v_size))
+        self.level = numpy.zeros((h_size, v_size), dtype=numpy.uint8)
 
         pos = [
-            random.randint(1, h_size - 2),
-            random.randint(1, v_size - 2)
+            rng.randint(1, h_size - 2),
+            rng.randint(1, v_size - 2)
             ]
         self.start_pos = pygame.Rect(pos[0]*32, pos[1]*32, 0, 0)
 
-        self.start_dir = random.choice(DIRECTIONS)
+        self.start_dir = rng.choice(DIRECTIONS)
         dire = self.start_dir
 
         self.level[pos[0],pos[1]] = 1
         for i in range(0,50):
-            for step in range(4,random.randint(5,25)):
+            for step in range(4,rng.randint(5,25)):
                 if dire == UP:
                     pos[1] -= 1
                     if pos[1] < 1 :
                         pos[1] = 1
-                        dire = random.choice((DOWN,LEFT,RIGHT))
+                        dire = rng.choice((DOWN,LEFT,RIGHT))
 
                 if dire == DOWN:
                     pos[1] += 1
                     if pos[1] > v_size - 2:
                         pos[1] = v_size- 2
-                        dire = random.choice((LEFT,RIGHT,UP))
+                        dire = rng.choice((LEFT,RIGHT,UP))
 
                 if dire == LEFT:
                     pos[0] += 1
                     if pos[0] > h_size - 2:
                         pos[0] = h_size - 2
-                        dire = random.choice((DOWN,RIGHT,UP))
+                        dire = rng.choice((DOWN,RIGHT,UP))
 
                 if dire == RIGHT:
                     pos[0] -= 1
                     if pos[0] < 1:
                         pos[0] = 1
-                        dire = random.choice((DOWN,LEFT,UP))
+                        dire = rng.choice((DOWN,LEFT,UP))
 
                 self.level[pos[0],pos[1]] = 1
             choices = DIRECTIONS[:]
             choices.pop(dire)
-            dire = random.choice(choices)
+            dire = rng.choice(choices)
         print "map ok"
 
-    def autolayout(self, x, y):
-        if self.level[x,y] == 0:
-            # place tiles according to surroundings
-            # the resulting surface is 32x32
-            if self.sprites[x, y]:
-                tile = self.sprites[x, y]
-            else:
-                tile = pygame.sprite.Sprite(self.blockers)
-
-            tile.image = pygame.Surface((32,32))
-            # get value for 8 tiles surroundings
-            def get_adj_tile(x, y):
-                if x > self.h_size-1 or x < 0 :
-                    return 0
-                if y > self.v_size-1 or y < 0 :
-                    return 0
-                return int(self.level[x,y])
-
-            n  = int(get_adj_tile(x,y-1))   << 0
-            ne = int(get_adj_tile(x+1,y-1)) << 1
-            e  = int(get_adj_tile(x+1,y))   << 2
-            se = int(get_adj_tile(x+1,y+1)) << 3
-            s  = int(get_adj_tile(x,y+1))   << 4
-            sw = int(get_adj_tile(x-1,y+1)) << 5
-            w  = int(get_adj_tile(x-1,y))   << 6
-            nw = int(get_adj_tile(x-1,y-1)) << 7
-
-            v = n+s+e+w+nw+ne+sw+se
-            # Assign a bit for each tile surrounding
-            # | 128 |   1 |   2 |
-            # |  64 | til |   4 |
-            # |  32 |  16 |   8 |
-            #
-            # then for each quadrant of our tile, the surroudings are
-            # represented by values
-            qNW = v & 0b11000001
-            qNE = v & 0b00000111
-            qSE = v & 0b00011100
-            qSW = v & 0b01110000
-
-            # O is empty (==1)
-            # X is filled (==0)
-            # add the values for Os
-
-            # for the NW quadrant (x is our tile, O is empty, X is
-            # filled)
-            if qNW == 193 or qNW == 65:
-                # OO XO
-                # Ox Ox
-                tNW = self.blocks['NW']
-            elif qNW == 1 or qNW == 129:
-                # OO XO
-                # Xx Xx
-                tNW = self.blocks['N1']
-            elif qNW == 192 or qNW == 64:
-                # OX XX
-                # Ox Ox
-                tNW = self.blocks['W1']
-            elif qNW == 128:
-                # OX
-                # Xx
-                tNW = self.blocks['iNW']
-            else:
-                # XX
-                # Xx
-                tNW = self.blocks['mNW']
-
-            if qNE == 7 or qNE == 5:
-                # 111
-                # OO OX
-                # xO xO
-                tNE = self.blocks['NE']
-            elif qNE == 3 or qNE == 1:
-                # OO OX
-                # xX xX
-                tNE = self.blocks['N2']
-            elif qNE == 6 or qNE == 4:
-                # XO XX
-                # xO xO
-                tNE = self.blocks['E1']
-            elif qNE == 2:
-                # X0
-                # xX
-                tNE = self.blocks['iNE']
-            else:
-                # XX
-                # xX
-                tNE = self.blocks['mNE']
-
-            if qSE == 28 or qSE == 20:
-                # 111
-                # xO xO
-                # OO OX
-                tSE = self.blocks['SE']
-            elif qSE == 12 or qSE == 4:
-                # xO xO
-                # XO XX
-                tSE = self.blocks['E2']
-            elif qSE == 24 or qSE == 16:
-                # xX xX
-                # OO OX
-                tSE = self.blocks['S2']
-            elif qSE == 8:
-                # xX
-                # XO
-                tSE = self.blocks['iSE']
-            else:
-                # xX
-                # XX
-                tSE = self.blocks['mSE']
-
-            if qSW == 112 or qSW == 80:
-                # 111
-                # Ox Ox
-                # OO XO
-                tSW = self.blocks['SW']
-            elif qSW == 48 or qSW == 16:
-                # Xx Xx
-                # OO XO
-                tSW = self.blocks['S1']
-            elif qSW == 96 or qSW == 64:
-                # Ox Ox
-                # OX XX
-                tSW = self.blocks['W2']
-            elif qSW == 32:
-                # Xx
-                # OX
-                tSW = self.blocks['iSW']
-            else:
-                # Xx
-                # XX
-                tSW = self.blocks['mSW']
-
+    def neighbour_mask(self, x, y):
+        """
+        Return the 8 bits mask of the empty tiles surrounding (x, y)
 
-            # We blit the smaller tiles into a larger one
-            tile.image.blit(tNW, (0,0))
-            tile.image.blit(tNE, (16,0))
-            tile.image.blit(tSE, (16,16))
-            tile.image.blit(tSW, (0,16))
-            tile.rect = pygame.rect.Rect((x*32,y*32), (32,32))
-            self.outline(tile)
-            self.add_bonuses(tile)
+        See neighbour_masks() to compute the masks of a whole level at once
+        """
+        # get value for 8 tiles surroundings
+        def get_adj_tile(x, y):
+            if x > self.h_size-1 or x < 0 :
+                return 0
+            if y > self.v_size-1 or y < 0 :
+                return 0
+            return int(self.level[x,y])
+
+        n  = int(get_adj_tile(x,y-1))   << 0
+        ne = int(get_adj_tile(x+1,y-1)) << 1
+        e  = int(get_adj_tile(x+1,y))   << 2
+        se = int(get_adj_tile(x+1,y+1)) << 3
+        s  = int(get_adj_tile(x,y+1))   << 4
+        sw = int(get_adj_tile(x-1,y+1)) << 5
+        w  = int(get_adj_tile(x-1,y))   << 6
+        nw = int(get_adj_tile(x-1,y-1)) << 7
+
+        return n+s+e+w+nw+ne+sw+se
+
+    def autolayout(self, x, y, mask=None):
+        """
+        Update the neighbour mask of (x, y), its surface follows from it
+        """
+        if mask is None:
+            mask = self.neighbour_mask(x, y)
+        self.masks[x, y] = mask
+        self.terrain.invalidate(x, y)
 
-        else:
-            tile = pygame.sprite.Sprite(self.tiles)
-            tile.image = self.empty_tile
-            tile.rect = pygame.rect.Rect((x*32,y*32), self.empty_tile.get_size())
+    def relayout(self, x, y):
+        """
+        Update the masks of the neighbours of (x, y) after its terrain changed
 
-        self.sprites[x,y] = tile
+        Only the bit pointing at (x, y) changes in each neighbour mask. Walls
+        whose corner blocks stay the same are left alone. Return the cells
+        whose surface changed, they are invalidated in the terrain cache.
+        """
+        empty = self.level[x, y] != 0
+        changed = [(x, y)]
+        for (dx, dy, bit) in NEIGHBOURS:
+            # (x, y) is the (dx, dy) neighbour of (x - dx, y - dy)
+            (nx, ny) = (x - dx, y - dy)
+            if nx < 0 or nx >= self.h_size or ny < 0 or ny >= self.v_size:
+                continue
+            old = int(self.masks[nx, ny])
+            if empty:
+                new = old | (1 << bit)
+            else:
+                new = old & ~(1 << bit)
+            self.masks[nx, ny] = new
+            if (self.level[nx, ny] == 0 and
+                    quadrant_blocks(*quadrant_codes(old)) !=
+                    quadrant_blocks(*quadrant_codes(new))):
+                changed.append((nx, ny))
 
-    def outline(self, tile, color=(0,0,0)):
-        pixels = pygame.surfarray.array3d(tile.image)
-        pixels[::,::31] = [0,0,0]
-        pixels[::31,::] = [0,0,0]
-        tile.image = pygame.surfarray.make_surface(pixels)
+        for cell in changed:
+            self.terrain.invalidate(*cell)
+        return changed
 
     def select(self, x, y):
-        tile = self.sprites[x,y]
-        self.selected_orig = tile.image
-        newimg = tile.image.copy()
-        # groups = tile.groups()
-        # tile.remove(groups)
-        newimg.blit(self.select_sprite, (0,0))
-        tile.image = newimg
-        # tile.add(groups)
+        self.selected = (x, y)
+        self.highlight.rect.topleft = (x*32, y*32)
+        if not self.highlight.alive():
+            self.tiles.add(self.highlight, layer=1)
+        # jump there rather than slide from the previous cell
+        self.tiles.moved(self.highlight)
 
     def unselect(self, x, y):
-        tile = self.sprites[x,y]
-        if self.selected_orig:
-            tile.image = self.selected_orig
-            self.selected_orig = None
+        if self.selected == (x, y):
+            self.selected = None
+            self.highlight.kill()
 
-    def add_bonuses(self, tile):
-        pass
+class CellIndex(object):
+    """
+    A set of (x, y) cells with O(1) add, discard and uniform random pick
+    """
+    def __init__(self):
+        self.cells = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, cell):
+        return cell in self.positions
+
+    def add(self, cell):
+        if cell not in self.positions:
+            self.positions[cell] = len(self.cells)
+            self.cells.append(cell)
+
+    def discard(self, cell):
+        position = self.positions.pop(cell, None)
+        if position is None:
+            return
+        # the last cell takes the place of the discarded one
+        last = self.cells.pop()
+        if position < len(self.cells):
+            self.cells[position] = last
+            self.positions[last] = position
+
+    def pick(self, rand=rng):
+        return self.cells[rand.randrange(len(self.cells))]
+
+# spill directories of the worlds not closed yet, removed at exit
+spill_dirs = set()
+
+def remove_spill_dirs():
+    for spill_dir in spill_dirs:
+        shutil.rmtree(spill_dir, True)
+
+atexit.register(remove_spill_dirs)
+
+def load_spill(path):
+    """
+    Return the arrays of a spilled chunk, the file is closed once read
+    """
+    with numpy.load(path) as spill:
+        return dict((name, spill[name]) for name in spill.files)
+
+# The state arrays of a world chunk that are saved, masks follow from level
+CHUNK_ARRAYS = [('level', numpy.uint8), ('bonus', numpy.uint8),
+    ('hitpoints', numpy.int8), ('value', numpy.int32)]
+
+class WorldChunk(object):
+    """
+    Rows [top, top + rows) of a WorldLevel, with their state arrays
+    """
+    def __init__(self, index, top, level):
+        self.index = index
+        self.top = top
+        self.level = level
+        self.masks = numpy.zeros(level.shape, dtype=numpy.uint8)
+        for (name, dtype) in CHUNK_ARRAYS[1:]:
+            setattr(self, name, numpy.zeros(level.shape, dtype=dtype))
+        # set when the chunk changed since it was generated or loaded
+        self.modified = False
+        self.last_used = 0
+
+    def arrays(self):
+        return dict((name, getattr(self, name).copy())
+            for (name, dtype) in CHUNK_ARRAYS)
+
+class ChunkedGrid(object):
+    """
+    A [x, y] indexable view over one of the state arrays (level, masks, ...)
+    of the chunks of a WorldLevel
+
+    Accessing a cell materialises its chunk. y can be a slice, the rows are
+    then gathered from the chunks they cross.
+    """
+    def __init__(self, world, name):
+        self.world = world
+        self.name = name
+
+    @property
+    def shape(self):
+        return (self.world.h_size, self.world.v_size)
+
+    def __getitem__(self, key):
+        (x, y) = key
+        rows = self.world.chunk_rows
+        if not isinstance(y, slice):
+            chunk = self.world.chunk(y // rows)
+            return getattr(chunk, self.name)[x, y - chunk.top]
+
+        (start, stop, step) = y.indices(self.world.v_size)
+        parts = []
+        while start < stop:
+            chunk = self.world.chunk(start // rows)
+            end = min(stop, chunk.top + rows)
+            parts.append(getattr(chunk, self.name)[x,
+                start - chunk.top:end - chunk.top])
+            start = end
+        if not parts:
+            chunk = self.world.chunk(0)
+            return getattr(chunk, self.name)[x, 0:0]
+        return numpy.concatenate(parts, axis=-1)
+
+    def __setitem__(self, key, value):
+        (x, y) = key
+        chunk = self.world.chunk(y // self.world.chunk_rows)
+        getattr(chunk, self.name)[x, y - chunk.top] = value
 
 class WorldLevel(MazeLevel):
-    bonus_set = pygame.image.load('res/gems.png')
+    """
+    A world.depth rows deep level, streamed by chunks of world.chunk_rows rows
 
-    def __init__(self):
+    A chunk is generated (or reloaded from disk), laid out and materialised
+    the first time one of its cells is accessed, which update() does ahead of
+    the camera. Beyond world.chunks_in_memory chunks, the least recently used
+    ones out of sight are evicted, their state spilled to disk when it was
+    modified. The state arrays are ChunkedGrid views over the chunks.
+
+    A world resumed from a SavedGame loads the chunks it saved from it, the
+    others are generated from the saved seed.
+    """
+
+    def __init__(self, saved=None):
+        self.saved = saved
+        self.bonus_set = resources.loadImage(resources.getImage('gems'))
         self.bonuses = {
             'diamond':{'value':1000, 'rarity':2, 'mindepth':50, 'hardness':4,
                 'sprite': self.bonus_set.subsurface(pygame.Rect(0,0,32,32))},
@@ -417,109 +1012,328 @@ class WorldLevel(MazeLevel):
 
         self.worms_count = 0
         self.worms_max = 20
+        # walls without bonus of the worm depth band, in materialised chunks
+        self.worm_cells = CellIndex()
         super(WorldLevel, self).__init__()
 
 
 
     def generate(self):
-        self.level = numpy.zeros((self.h_size, self.v_size))
-        self.level[::,0:4] = 1
+        if self.saved is None:
+            self.v_size = resources.getValue('world.depth')
+            self.chunk_rows = resources.getValue('world.chunk_rows')
+            # chunks are generated from their own seed, so they can be thrown
+            # away and generated again as long as they were not modified
+            self.seed = rng.getrandbits(32)
+        else:
+            (self.h_size, self.v_size) = self.saved.size
+            self.chunk_rows = self.saved.chunk_rows
+            self.seed = self.saved.seed
+        self.max_chunks = resources.getValue('world.chunks_in_memory')
+        self.chunk_count = (self.v_size - 1) // self.chunk_rows + 1
+        self.chunks = {}
+        self.chunk_clock = 0
+        self.spill_dir = tempfile.mkdtemp(prefix='ld29-world-')
+        # index: path of the spilled chunks, the paths given by the last
+        # snapshot() and the replaced files they keep from being removed
+        self.spilled = {}
+        self.spill_count = 0
+        self.pinned = set()
+        self.stale = []
+        spill_dirs.add(self.spill_dir)
+
+        self.level = ChunkedGrid(self, 'level')
         self.start_pos = pygame.Rect((64,64),(0,0))
 
+    def generate_chunk(self, index):
+        top = index * self.chunk_rows
+        level = numpy.zeros((self.h_size,
+            min(self.chunk_rows, self.v_size - top)), dtype=numpy.uint8)
+        level[::,0:max(4 - top, 0)] = 1
+        return level
+
+    def layout(self):
+        for name in ('masks', 'bonus', 'hitpoints', 'value'):
+            setattr(self, name, ChunkedGrid(self, name))
+        self.stream(max(self.start_pos.y - 240, 0))
+
+    def wall_cells(self):
+        # only the materialised chunks are considered
+        (xs, ys) = ([], [])
+        for chunk in self.chunks.values():
+            (chunk_xs, chunk_ys) = numpy.nonzero(chunk.level == 0)
+            xs.append(chunk_xs)
+            ys.append(chunk_ys + chunk.top)
+        return (numpy.concatenate(xs), numpy.concatenate(ys))
+
+    def walls_at(self, xs, ys):
+        # cells are looked up chunk by chunk, materialising them as needed
+        walls = numpy.empty(len(xs), dtype=bool)
+        indexes = ys // self.chunk_rows
+        for index in numpy.unique(indexes):
+            cells = indexes == index
+            chunk = self.chunk(index)
+            walls[cells] = chunk.level[xs[cells], ys[cells] - chunk.top] == 0
+        return walls
+
+    def state_arrays(self):
+        # only the chunks in memory are considered
+        return [getattr(self.chunks[index], name).tostring()
+            for index in sorted(self.chunks)
+            for (name, dtype) in CHUNK_ARRAYS]
+
+    def update(self, dt, game):
+        super(WorldLevel, self).update(dt, game)
+        self.stream(self.tiles.camera[1])
+
+    def stream(self, camera_y, height=480):
+        """
+        Materialise the chunks around the camera and evict the least recently
+        used ones beyond the budget
+        """
+        span = self.chunk_rows * 32
+        first = max(camera_y // span - 1, 0)
+        last = min((camera_y + height - 1) // span + 1, self.chunk_count - 1)
+        for index in range(first, last + 1):
+            self.chunk(index)
+
+        if len(self.chunks) > self.max_chunks:
+            evictable = [chunk for chunk in self.chunks.values()
+                if not first <= chunk.index <= last]
+            evictable.sort(key=lambda chunk: chunk.last_used)
+            for chunk in evictable[:len(self.chunks) - self.max_chunks]:
+                self.evict(chunk)
+
+    def chunk(self, index):
+        chunk = self.chunks.get(index, None)
+        if chunk is None:
+            if index < 0 or index >= self.chunk_count:
+                raise IndexError('chunk %d is out of the world' % index)
+            chunk = self.materialise(index)
+        self.chunk_clock += 1
+        chunk.last_used = self.chunk_clock
+        return chunk
+
+    def spill_path(self, index):
+        # a new file each time, files can't be replaced on Windows
+        self.spill_count += 1
+        return os.path.join(self.spill_dir, '%d-%d.npz' % (index,
+            self.spill_count))
+
+    def load_chunk(self, index):
+        """
+        Return the arrays of a chunk spilled to disk or saved, None if it is
+        generated
+        """
+        if index in self.spilled:
+            return load_spill(self.spilled[index])
+        if self.saved is not None:
+            return self.saved.chunk(index)
+        return None
+
+    def close(self):
+        # saves of the world must be written, they read the spilled chunks
+        # and the mapped save the world was resumed from
+        self.saved = None
+        shutil.rmtree(self.spill_dir, True)
+        spill_dirs.discard(self.spill_dir)
+        self.spilled.clear()
+        self.pinned.clear()
+        del self.stale[:]
+
+    def snapshot(self):
+        """
+        Return {index: arrays} for the chunks that differ from their
+        generation
+
+        Chunks that are not modified in memory are given as a function
+        loading them from disk, which can be called from another thread. The
+        spill files they read are kept until the next snapshot.
+        """
+        chunks = {}
+        if self.saved is not None:
+            chunks = dict((index, functools.partial(self.saved.chunk, index))
+                for index in self.saved.offsets)
+        for (index, path) in self.spilled.items():
+            chunks[index] = functools.partial(load_spill, path)
+        self.pinned = set(self.spilled.values())
+        for path in self.stale:
+            os.remove(path)
+        del self.stale[:]
+        for chunk in self.chunks.values():
+            if chunk.modified:
+                chunks[chunk.index] = chunk.arrays()
+        return chunks
+
+    def chunk_terrain(self, index):
+        """
+        Return the terrain of a chunk without materialising it
+        """
+        if index in self.chunks:
+            return self.chunks[index].level
+        saved = self.load_chunk(index)
+        if saved is None:
+            return self.generate_chunk(index)
+        return saved['level']
+
+    def materialise(self, index):
+        top = index * self.chunk_rows
+        saved = self.load_chunk(index)
+        if saved is None:
+            chunk = WorldChunk(index, top, self.generate_chunk(index))
+        else:
+            chunk = WorldChunk(index, top, numpy.array(saved['level']))
+        self.chunks[index] = chunk
+
+        # neighbour masks need the rows just above and below the chunk
+        (h_size, rows) = chunk.level.shape
+        halo = numpy.zeros((h_size, rows + 2), dtype=numpy.uint8)
+        halo[:, 1:-1] = chunk.level
+        if index > 0:
+            halo[:, 0] = self.chunk_terrain(index - 1)[:, -1]
+        if index < self.chunk_count - 1:
+            halo[:, -1] = self.chunk_terrain(index + 1)[:, 0]
+        chunk.masks[:] = neighbour_masks(halo)[:, 1:-1]
+
+        if saved is None:
+            chunk.bonus[:] = self.place_bonuses(chunk.level, top,
+                numpy.random.RandomState([self.seed, index]))
+            chunk.hitpoints[:] = self.bonus_hardness[chunk.bonus]
+            chunk.value[:] = self.bonus_values[chunk.bonus]
+        else:
+            for name in ('bonus', 'hitpoints', 'value'):
+                getattr(chunk, name)[:] = saved[name]
+        self.worms_count += self.count_worms(chunk)
+        for (x, y) in self.worm_band_cells(chunk):
+            if chunk.level[x, y - top] == 0 and chunk.bonus[x, y - top] == 0:
+                self.worm_cells.add((x, y))
+        self.terrain.forget_rows(top, top + rows)
+        return chunk
+
+    def worm_band(self):
+        """
+        Return the first and last rows worms spawn in
+        """
+        worm = self.bonuses['worm']
+        return (min(worm['mindepth'], self.v_size - 1),
+            min(worm['maxdepth'], self.v_size - 1))
+
+    def worm_band_cells(self, chunk):
+        (first, last) = self.worm_band()
+        rows = range(max(first, chunk.top),
+            min(last + 1, chunk.top + chunk.level.shape[1]))
+        return [(x, y) for y in rows for x in range(self.h_size)]
+
+    def count_worms(self, chunk):
+        return numpy.count_nonzero(
+            chunk.bonus == self.bonus_names.index('worm'))
+
+    def evict(self, chunk):
+        if chunk.modified:
+            self.spill(chunk)
+        self.worms_count -= self.count_worms(chunk)
+        for cell in self.worm_band_cells(chunk):
+            self.worm_cells.discard(cell)
+        del self.chunks[chunk.index]
+        self.terrain.forget_rows(chunk.top, chunk.top + chunk.level.shape[1])
+
+    def spill(self, chunk):
+        path = self.spill_path(chunk.index)
+        with open(path, 'wb') as spill_file:
+            numpy.savez(spill_file, **chunk.arrays())
+        previous = self.spilled.get(chunk.index, None)
+        self.spilled[chunk.index] = path
+        if previous in self.pinned:
+            # a save may be reading it
+            self.stale.append(previous)
+        elif previous is not None:
+            os.remove(previous)
+
+    def mark_modified(self, y):
+        self.chunk(y // self.chunk_rows).modified = True
+
     def set_tiles(self):
-        self.tileset = pygame.image.load(resources.getImage('level'))
+        self.tileset = resources.loadImage(resources.getImage('level'))
         # TODO: load a specific tile from resources
         (base_x, base_y) = (16,14)
         self.blocks = self.get_blocks(base_x, base_y)
+        self.atlas = TileAtlas.get(
+            (resources.getImage('level'), base_x, base_y), self.blocks)
+        for bonus_name in self.bonuses:
+            self.atlas.add_overlay(bonus_name, self.bonuses[bonus_name]['sprite'])
         self.empty_tile = self.tileset.subsurface(pygame.Rect(0,32,32,32))
 
-    def add_bonuses(self, tile):
-
-        if not tile in self.blockers:
-            return
-
-        if hasattr(tile, 'bonus') and tile.bonus :
-            # reset previous bonus
-            self.set_bonus(tile, tile.bonus, reset=True)
-        else:
-            tile.bonus = 'None'
-            tile.value = 0
-            tile.hitpoints = 0
-            # set random bonus
-            rand = random.randint(0,100)
-            if rand < 50:
-                for bonus_name in self.bonuses:
-                    bonus = self.bonuses[bonus_name]
-                    if random.randint(0,100) < bonus['rarity']:
-                        self.set_bonus(tile, bonus_name)
-                        break;
-
     def add_worm(self):
-        if self.worms_count >= self.worms_max:
-            return False
-
-        for i in range(0,100):
-            tx = random.randint(0,self.h_size-1)
-            ty = random.randint(
-                min(self.bonuses['worm']['mindepth'], self.v_size-1),
-                min(self.bonuses['worm']['maxdepth'], self.v_size-1)
-                )
-
-            tile = self.sprites[tx, ty]
-
-            if self.level[tx, ty] or tile.bonus != 'None':
-                continue
-
-            return self.set_bonus(tile, 'worm')
+        """
+        Spawn a worm, return False if there is no room for one
+        """
+        return self.add_worms(1) == 1
 
-    def set_bonus(self, tile, bonus_name, reset=False):
+    def add_worms(self, count):
+        """
+        Spawn up to count worms on walls without bonus of the worm depth band,
+        return how many were spawned
+        """
+        (first, last) = self.worm_band()
+        for index in range(first // self.chunk_rows,
+                last // self.chunk_rows + 1):
+            self.chunk(index)
+
+        count = max(min(count, self.worms_max - self.worms_count,
+            len(self.worm_cells)), 0)
+        for i in range(count):
+            (x, y) = self.worm_cells.pick()
+            self.mark_modified(y)
+            self.set_bonus(x, y, 'worm')
+        return count
+
+    def set_bonus(self, x, y, bonus_name):
         bonus = self.bonuses.get(bonus_name, None)
         if not bonus :
             return False
 
         # do not set bonus if the depth is not proper
-        if (tile.rect.y/32) < bonus['mindepth']:
+        if y < bonus['mindepth']:
             return False
 
         bonus_max_depth = bonus.get('maxdepth', 0)
-        if bonus_max_depth > 0 and (tile.rect.y/32) > bonus_max_depth:
+        if bonus_max_depth > 0 and y > bonus_max_depth:
             return False
 
-        tile.image.blit(bonus['sprite'], (0,0))
-        if not reset :
-            tile.value = bonus['value']
-            tile.hitpoints = bonus['hardness']
-            tile.bonus = bonus_name
-            if tile.bonus == 'worm':
-                self.worms_count += 1
+        bonus_id = self.bonus_names.index(bonus_name)
+        self.worm_cells.discard((x, y))
+        self.bonus[x, y] = bonus_id
+        self.value[x, y] = self.bonus_values[bonus_id]
+        self.hitpoints[x, y] = self.bonus_hardness[bonus_id]
+        self.terrain.invalidate(x, y)
+        if bonus_name == 'worm':
+            self.worms_count += 1
 
     def dig_out(self, tile):
-        if tile.hitpoints > 0:
-            tile.hitpoints -= 1
+        (x, y) = (tile.x, tile.y)
+        self.mark_modified(y)
+        if self.hitpoints[x, y] > 0:
+            self.hitpoints[x, y] -= 1
 
             anim = EffectAnimation(0, [])
             anim.rect = tile.rect.copy()
             self.tiles.add(anim, layer=1)
         else:
             if tile in self.blockers:
-                self.blockers.remove(tile)
+                value = int(self.value[x, y])
                 if tile.bonus == 'worm':
                     self.worms_count -= 1
-                (x,y) = (tile.rect.x/32, tile.rect.y/32)
+                self.bonus[x, y] = 0
+                self.value[x, y] = 0
                 self.level[x, y] = 1
+                self.worm_cells.discard((x, y))
                 # We need to relayout surrounding tiles
-                for ny in range(y-1,y+2):
-                    for nx in range(x-1,x+2):
-                        if nx > self.h_size - 1 or nx < 0:
-                            continue
-                        if ny > self.v_size - 1 or ny < 0:
-                            continue
-                        self.autolayout(nx, ny)
+                self.relayout(x, y)
                 self.select(x,y)
                 anim = EffectAnimation(1, [])
                 anim.rect = tile.rect.copy()
                 self.tiles.add(anim, layer=1)
-                return tile.value
+                return value
         return 0
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+"""
+Saved games
+
+A save file is made of:
+
+    'LD29SAVE', the format version and the header length (2 uint32)
+    the header, in JSON: serial number of the save, seed, sizes, player
+    position, score, remaining time and the offset of each saved chunk
+    the arrays of the saved chunks, raw, in CHUNK_ARRAYS order and aligned on
+    ALIGN bytes
+
+Only the chunks that differ from their generation are saved. Loading reads the
+header and memory maps the chunk arrays, they are only read when the world
+needs them.
+
+A game is saved in turn to SLOTS files, named after the save file, and resumed
+from the newest complete one: files can't be replaced on Windows, the one a
+resumed game maps least of all.
+"""
+__author__ = 'Anbcorp'
+
+import json
+import numpy
+import os
+import struct
+import threading
+
+from src.level import CHUNK_ARRAYS
+
+MAGIC = 'LD29SAVE'
+VERSION = 1
+ALIGN = 16
+SLOTS = 2
+
+def aligned(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+def chunk_rows(header, index):
+    return min(header['chunk_rows'], header['size'][1] -
+        index * header['chunk_rows'])
+
+def chunk_size(header, index):
+    """
+    Return the bytes taken by the arrays of a chunk
+    """
+    cells = header['size'][0] * chunk_rows(header, index)
+    return sum(aligned(cells * numpy.dtype(dtype).itemsize)
+        for (name, dtype) in CHUNK_ARRAYS)
+
+def snapshot(game):
+    """
+    Return the (header, chunks) of a save of game, to be given to write()
+    """
+    world = game.current_level
+    header = {
+        'seed': world.seed,
+        'size': [world.h_size, world.v_size],
+        'chunk_rows': world.chunk_rows,
+        'player': list(game.player.rect.topleft),
+        'score': game.player.score,
+        'rem_time': game.rem_time,
+    }
+    return (header, world.snapshot())
+
+def write(filename, header, chunks):
+    """
+    Write a save file, see WorldLevel.snapshot() for chunks
+
+    A crash leaves the file incomplete, read_header() refuses it.
+    """
+    offsets = []
+    offset = 0
+    for index in sorted(chunks):
+        offsets.append([index, offset])
+        offset += chunk_size(header, index)
+    header = dict(header, chunks=offsets)
+    text = json.dumps(header)
+    start = aligned(len(MAGIC) + 8 + len(text))
+
+    with open(filename, 'wb') as save_file:
+        save_file.write(MAGIC)
+        save_file.write(struct.pack('<II', VERSION, len(text)))
+        save_file.write(text)
+        save_file.write('\0' * (start - save_file.tell()))
+        for index in sorted(chunks):
+            arrays = chunks[index]
+            if callable(arrays):
+                arrays = arrays()
+            for (name, dtype) in CHUNK_ARRAYS:
+                data = numpy.ascontiguousarray(arrays[name], dtype).tostring()
+                save_file.write(data)
+                save_file.write('\0' * (aligned(len(data)) - len(data)))
+
+def write_async(filename, header, chunks):
+    """
+    Write a save file from a background thread, return the thread
+    """
+    thread = threading.Thread(target=write, args=(filename, header, chunks))
+    thread.start()
+    return thread
+
+def read_header(filename):
+    """
+    Return (header, offset of the chunk arrays) of a save file, raise
+    ValueError if it is not a complete save
+    """
+    with open(filename, 'rb') as save_file:
+        magic = save_file.read(len(MAGIC) + 8)
+        if magic[:len(MAGIC)] != MAGIC or len(magic) < len(MAGIC) + 8:
+            raise ValueError('%s is not a saved game' % filename)
+        (version, length) = struct.unpack('<II', magic[len(MAGIC):])
+        if version != VERSION:
+            raise ValueError('%s: unsupported save version %d' % (
+                filename, version))
+        header = json.loads(save_file.read(length))
+    start = aligned(len(MAGIC) + 8 + length)
+    end = start + sum(chunk_size(header, index)
+        for (index, offset) in header['chunks'])
+    if os.path.getsize(filename) < end:
+        raise ValueError('%s is truncated' % filename)
+    return (header, start)
+
+def slot_files(filename):
+    return ['%s.%d' % (filename, slot) for slot in range(SLOTS)]
+
+def saves(filename):
+    """
+    Return the (serial, slot file) of the complete saves of filename, newest
+    first
+    """
+    found = []
+    for path in slot_files(filename):
+        try:
+            (header, start) = read_header(path)
+        except (IOError, ValueError):
+            continue
+        found.append((header['serial'], path))
+    return sorted(found, reverse=True)
+
+def next_slot(filename, busy=()):
+    """
+    Return (serial, slot file) of the next save of filename: the oldest slot
+    that is not busy, the files mapped by SavedGames
+    """
+    serials = dict((path, serial) for (serial, path) in saves(filename))
+    free = [path for path in slot_files(filename) if path not in busy]
+    path = min(free, key=lambda path: serials.get(path, -1))
+    return (max(serials.values() or [0]) + 1, path)
+
+def load(filename):
+    """
+    Return the SavedGame of the newest complete save of filename
+    """
+    found = saves(filename)
+    if not found:
+        raise IOError('no saved game in %s' % ', '.join(slot_files(filename)))
+    return SavedGame(found[0][1])
+
+class SavedGame(object):
+    """
+    A save file, opened for resuming
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        (self.header, start) = read_header(filename)
+
+        self.seed = self.header['seed']
+        self.size = tuple(self.header['size'])
+        self.chunk_rows = self.header['chunk_rows']
+        self.player = tuple(self.header['player'])
+        self.score = self.header['score']
+        self.rem_time = self.header['rem_time']
+        self.offsets = dict(self.header['chunks'])
+        self.data = None
+        if self.offsets:
+            # copy on write, the world digs into the chunks it loads
+            self.data = numpy.memmap(filename, dtype=numpy.uint8, mode='c',
+                offset=start)
+
+    def chunk(self, index):
+        """
+        Return the arrays of a saved chunk, None if it was not saved
+        """
+        offset = self.offsets.get(index, None)
+        if offset is None:
+            return None
+        shape = (self.size[0], chunk_rows(self.header, index))
+        arrays = {}
+        for (name, dtype) in CHUNK_ARRAYS:
+            size = shape[0] * shape[1] * numpy.dtype(dtype).itemsize
+            arrays[name] = self.data[offset:offset + size].view(
+                dtype).reshape(shape)
+            offset += aligned(size)
+        return arrays